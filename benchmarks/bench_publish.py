@@ -0,0 +1,204 @@
+# coding=utf-8
+"""Micro-benchmarks for the plugin's publish hot paths.
+
+Runs HomeassistantPlugin against the stand-ins from fakes.py and reports the
+wall time and memory allocated per call of each hot path. Requires OctoPrint
+to be installed in the running environment.
+
+    python benchmarks/bench_publish.py --compare
+    python benchmarks/bench_publish.py --save
+
+Without a path both use benchmarks/baseline.json. Timings depend on the
+machine, save a baseline of the unchanged tree on the machine comparing.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from fakes import create_plugin, stop_plugin
+
+from octoprint.events import Events
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def bench_device_registration_cold(plugin, mqtt, i):
+    plugin._invalidate_topic_table()
+    plugin._discovery_cache.clear()
+    plugin._generate_device_registration()
+
+
+def bench_device_registration_warm(plugin, mqtt, i):
+    plugin._generate_device_registration()
+
+
+def bench_device_controls(plugin, mqtt, i):
+    plugin._discovery_cache.clear()
+    plugin._generate_device_controls()
+
+
+def bench_printer_status(plugin, mqtt, i):
+    plugin._printer.progress = (i % 1000) / 10.0
+    plugin._generate_printer_status()
+
+
+def bench_printer_status_unchanged(plugin, mqtt, i):
+    plugin._generate_printer_status()
+
+
+def bench_generate_topic(plugin, mqtt, i):
+    plugin._generate_topic("hassTopic", "printing", full=True)
+
+
+def bench_generate_topic_cold(plugin, mqtt, i):
+    plugin._invalidate_topic_table()
+    plugin._generate_topic("hassTopic", "printing", full=True)
+
+
+def bench_on_event_z_change(plugin, mqtt, i):
+    plugin._printer.z = i * 0.2
+    plugin.on_event(Events.Z_CHANGE, {"new": plugin._printer.z, "old": None})
+
+
+def bench_on_event_connecting(plugin, mqtt, i):
+    plugin.on_event(Events.CONNECTING, {})
+
+
+BENCHMARKS = [
+    ("device_registration_cold", bench_device_registration_cold, 200),
+    ("device_registration_warm", bench_device_registration_warm, 200),
+    ("device_controls", bench_device_controls, 200),
+    ("printer_status", bench_printer_status, 2000),
+    ("printer_status_unchanged", bench_printer_status_unchanged, 2000),
+    ("generate_topic", bench_generate_topic, 20000),
+    ("generate_topic_cold", bench_generate_topic_cold, 2000),
+    ("on_event_z_change", bench_on_event_z_change, 2000),
+    ("on_event_connecting", bench_on_event_connecting, 2000),
+]
+
+
+def run_benchmark(func, iterations, repeat):
+    # Status triggers are published synchronously so on_event measures the
+    # whole dispatch, not just scheduling a timer.
+    plugin, mqtt = create_plugin(
+        settings=dict(status_coalesce_window=0), extruders=2, heated_chamber=True
+    )
+    try:
+        for i in range(min(iterations, 100)):
+            func(plugin, mqtt, i)
+
+        timings = []
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            for i in range(iterations):
+                func(plugin, mqtt, i)
+            timings.append((time.perf_counter() - start) / iterations)
+
+        gc.collect()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for i in range(iterations):
+            func(plugin, mqtt, i)
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        stop_plugin(plugin)
+
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "best_us": timings[0] * 1e6,
+        "median_us": timings[len(timings) // 2] * 1e6,
+        "peak_bytes": peak - before,
+        "retained_bytes_per_call": (after - before) / float(iterations),
+        "messages": sum(mqtt.messages.values()),
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        _base = baseline.get(name)
+        if not _base:
+            continue
+        _ratio = result["median_us"] / _base["median_us"] if _base["median_us"] else 1
+        _flag = ""
+        if _ratio > 1 + tolerance:
+            _flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            "%-28s %10.2f us  baseline %10.2f us  %+6.1f%%%s"
+            % (name, result["median_us"], _base["median_us"], (_ratio - 1) * 100, _flag)
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="iterations multiplier")
+    parser.add_argument("--only", action="append", help="only run this benchmark")
+    parser.add_argument(
+        "--save",
+        nargs="?",
+        const=BASELINE,
+        help="write the results to this baseline file (default %(const)s)",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="?",
+        const=BASELINE,
+        help="compare the results with this baseline file (default %(const)s)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the baseline before failing (default 20%%)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = {}
+    for name, func, iterations in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = run_benchmark(
+            func, max(1, int(iterations * args.scale)), args.repeat
+        )
+        print(
+            "%-28s %10.2f us/call  peak %8d B  retained %8.1f B/call"
+            % (
+                name,
+                results[name]["median_us"],
+                results[name]["peak_bytes"],
+                results[name]["retained_bytes_per_call"],
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to " + args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# coding=utf-8
+"""Stand-ins for the OctoPrint objects and MQTT helpers injected into the plugin.
+
+They only implement what HomeassistantPlugin uses, and record every MQTT
+publish so benchmarks and soak runs can count messages and bytes.
+"""
+from __future__ import absolute_import
+
+import collections
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import octoprint.util  # noqa: E402
+
+import octoprint_homeassistant  # noqa: E402
+
+
+class FakeSettings(object):
+    def __init__(self, defaults, global_settings=None):
+        self.defaults = json.loads(json.dumps(defaults))
+        self.data = json.loads(json.dumps(defaults))
+        self.global_data = global_settings or {}
+        self.basefolder = tempfile.gettempdir()
+
+    def get(self, path, **kwargs):
+        value = self.data
+        for key in path:
+            value = value[key]
+        return value
+
+    def get_int(self, path, **kwargs):
+        return int(self.get(path))
+
+    def get_float(self, path, **kwargs):
+        return float(self.get(path))
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def get_all_data(self, **kwargs):
+        return json.loads(json.dumps(self.data))
+
+    def set(self, path, value, **kwargs):
+        if not path:
+            # Like PluginSettings, the values not given fall back to the defaults
+            self.data = octoprint.util.dict_merge(self.defaults, value)
+            return
+        data = self.data
+        for key in path[:-1]:
+            data = data.setdefault(key, {})
+        data[path[-1]] = value
+
+    def clean_all_data(self):
+        self.data = json.loads(json.dumps(self.defaults))
+
+    def global_get(self, path, **kwargs):
+        value = self.global_data
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def global_get_basefolder(self, name, **kwargs):
+        return self.basefolder
+
+
+class FakePrinter(object):
+    """Printer that walks through a print as progress is advanced."""
+
+    def __init__(self):
+        self.progress = 0.0
+        self.z = 0.0
+        self.paused = False
+        self.printing = False
+        self.connection = "Operational"
+        self.commands_sent = []
+        self.jogs = []
+
+    def get_current_data(self):
+        if self.paused:
+            _text = "Paused"
+        elif self.printing:
+            _text = "Printing"
+        else:
+            _text = "Operational"
+        return {
+            "state": {
+                "text": _text,
+                "flags": {
+                    "operational": True,
+                    "printing": self.printing,
+                    "paused": self.paused,
+                    "ready": not self.printing,
+                    "error": False,
+                },
+                "error": "",
+            },
+            "job": {
+                "file": {"name": "benchy.gcode", "path": "benchy.gcode", "size": 5242880},
+                "estimatedPrintTime": 86400,
+                "filament": {"tool0": {"length": 25000.0, "volume": 60.1}},
+                "user": "octoprint",
+            },
+            "progress": {
+                "completion": self.progress,
+                "filepos": int(self.progress * 52428.8),
+                "printTime": int(self.progress * 864),
+                "printTimeLeft": int((100 - self.progress) * 864),
+                "printTimeLeftOrigin": "estimate",
+            },
+            "currentZ": self.z,
+            "offsets": {},
+            "resends": {"count": 0, "transmitted": 1000, "ratio": 0},
+        }
+
+    def get_current_connection(self):
+        return self.connection, "/dev/ttyUSB0", 115200, None
+
+    def is_printing(self):
+        return self.printing
+
+    def commands(self, commands, **kwargs):
+        self.commands_sent.append(commands)
+
+    def jog(self, axes, relative=True, speed=None, **kwargs):
+        self.jogs.append((axes, speed))
+
+    def home(self, axes, **kwargs):
+        pass
+
+    def connect(self, **kwargs):
+        self.connection = "Operational"
+
+    def disconnect(self, **kwargs):
+        self.connection = "Closed"
+
+    def cancel_print(self, **kwargs):
+        self.printing = False
+
+    def pause_print(self, **kwargs):
+        self.paused = True
+
+    def resume_print(self, **kwargs):
+        self.paused = False
+
+
+class FakePrinterProfileManager(object):
+    def __init__(self, extruders=1, heated_chamber=False):
+        self.profile = {
+            "extruder": {"count": extruders},
+            "heatedChamber": heated_chamber,
+        }
+
+    def get_current_or_default(self):
+        return self.profile
+
+
+class FakeMqtt(object):
+    """In-process stand-in for the OctoPrint-MQTT helpers.
+
+    Publishes are recorded per topic, subscriptions support the + and #
+    wildcards so messages can be delivered back to the plugin.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connected = True
+        self.messages = collections.Counter()
+        self.bytes = collections.Counter()
+        self.published = []
+        self.record = False
+        self.subscriptions = []
+
+    def publish(self, topic, payload, retained=None, qos=None, allow_queueing=False, raw_data=False):
+        if not self.connected:
+            return False
+        if not raw_data and not isinstance(payload, (str, bytes)):
+            payload = json.dumps(payload)
+        with self._lock:
+            self.messages[topic] += 1
+            self.bytes[topic] += len(payload)
+            if self.record:
+                self.published.append((time.monotonic(), topic, payload))
+        return True
+
+    def publish_with_timestamp(self, topic, payload, retained=None, qos=None, allow_queueing=False, timestamp=None):
+        payload = dict(payload)
+        payload["_timestamp"] = int(timestamp or time.time())
+        return self.publish(topic, payload, retained, qos, allow_queueing)
+
+    def subscribe(self, topic, callback, **kwargs):
+        with self._lock:
+            self.subscriptions.append((topic, callback))
+
+    def unsubscribe(self, callback, topic=None):
+        with self._lock:
+            self.subscriptions = [
+                (t, c)
+                for t, c in self.subscriptions
+                if not (c == callback and (topic is None or t == topic))
+            ]
+
+    def deliver(self, topic, payload, retained=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            _matches = [c for t, c in self.subscriptions if topic_matches(t, topic)]
+        for callback in _matches:
+            callback(topic, payload, retained=retained, qos=0)
+
+    def reset(self):
+        with self._lock:
+            self.messages.clear()
+            self.bytes.clear()
+            del self.published[:]
+
+
+def topic_matches(subscription, topic):
+    _sub = subscription.split("/")
+    _topic = topic.split("/")
+    for i, part in enumerate(_sub):
+        if part == "#":
+            return True
+        if i >= len(_topic) or (part != "+" and part != _topic[i]):
+            return False
+    return len(_sub) == len(_topic)
+
+
+class FakePluginManager(object):
+    def __init__(self, mqtt):
+        self.mqtt = mqtt
+
+    def get_helpers(self, name, *helpers):
+        if name != "mqtt":
+            return None
+        return {
+            "mqtt_publish": self.mqtt.publish,
+            "mqtt_publish_with_timestamp": self.mqtt.publish_with_timestamp,
+            "mqtt_subscribe": self.mqtt.subscribe,
+            "mqtt_unsubscribe": self.mqtt.unsubscribe,
+        }
+
+
+def create_plugin(settings=None, extruders=1, heated_chamber=False, snapshot=None):
+    """Returns a started plugin wired to fakes, and the fake MQTT helpers."""
+    import octoprint.settings
+
+    try:
+        octoprint.settings.settings()
+    except ValueError:
+        # Not initialised yet, OctoPrint refuses a second init
+        octoprint.settings.settings(init=True, basedir=tempfile.mkdtemp())
+
+    plugin = octoprint_homeassistant.HomeassistantPlugin()
+    _settings = FakeSettings(
+        plugin.get_settings_defaults(),
+        global_settings={
+            "webcam": {"timelapseEnabled": bool(snapshot), "snapshot": snapshot},
+            "server": {"commands": {}},
+        },
+    )
+    _settings.data.update(unique_id="benchmark", node_id="BENCH1")
+    _settings.data.update(settings or {})
+
+    mqtt = FakeMqtt()
+    plugin._identifier = "homeassistant"
+    plugin._plugin_version = "benchmark"
+    plugin._settings = _settings
+    plugin._printer = FakePrinter()
+    plugin._printer_profile_manager = FakePrinterProfileManager(extruders, heated_chamber)
+    plugin._plugin_manager = FakePluginManager(mqtt)
+
+    plugin.on_after_startup()
+    return plugin, mqtt
+
+
+def stop_plugin(plugin):
+    for timer in (plugin.update_timer, plugin.constant_timer, plugin.history_timer):
+        if timer:
+            timer.cancel()
+    plugin.on_shutdown()
@@ -0,0 +1,513 @@
+# coding=utf-8
+"""Compressed-time soak test of a full print.
+
+Replays a simulated print (24 hours by default) into the plugin as fast as
+possible: temperature reports, progress callbacks, layer changes, a pause and
+resume, timelapse captures, camera snapshots, broker outages and settings
+saves.
+
+Everything runs synchronously on one thread against a virtual clock. The
+clock replaces the time module of every plugin module, fires the plugin's
+timers when they are due and the publish worker is drained after each step,
+so deadbands, intervals, rate limits and the offline buffer behave as they
+would in real time. Only the camera streamer is real, a local HTTP server.
+
+Reports messages and bytes per topic, publish hand-off latency percentiles,
+offline buffer usage and RSS/tracemalloc growth. Requires OctoPrint to be
+installed.
+
+    python benchmarks/soak.py --hours 24 --prints 7
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import gc
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+
+from fakes import create_plugin, stop_plugin
+
+import octoprint_homeassistant
+import octoprint_homeassistant.commands
+import octoprint_homeassistant.publisher
+import octoprint_homeassistant.util
+from octoprint.events import Events
+
+# Modules of the plugin reading the time module
+PLUGIN_MODULES = (
+    octoprint_homeassistant,
+    octoprint_homeassistant.commands,
+    octoprint_homeassistant.publisher,
+    octoprint_homeassistant.util,
+)
+
+
+class VirtualClock(object):
+    """Replacement for the time module as seen by the plugin.
+
+    Callbacks scheduled with call_later() run on the thread advancing the
+    clock, once their due time is reached.
+    """
+
+    def __init__(self):
+        self._now = time.monotonic()
+        self._epoch = time.time() - self._now
+        self._scheduled = []
+        self._sequence = itertools.count()
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._epoch + self._now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def call_later(self, delay, callback):
+        heapq.heappush(
+            self._scheduled, (self._now + max(0, delay), next(self._sequence), callback)
+        )
+
+    def advance(self, seconds):
+        _target = self._now + max(0, seconds)
+        while self._scheduled and self._scheduled[0][0] <= _target:
+            _due, _, callback = heapq.heappop(self._scheduled)
+            self._now = max(self._now, _due)
+            callback()
+        self._now = _target
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class VirtualTimer(object):
+    """threading.Timer firing on the virtual clock."""
+
+    def __init__(self, clock, interval, function, args=None, kwargs=None):
+        self._clock = clock
+        self.interval = interval
+        self.function = function
+        self.args = args or []
+        self.kwargs = kwargs or {}
+        self.daemon = True
+        self._cancelled = False
+
+    def start(self):
+        self._clock.call_later(self.interval, self._fire)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _fire(self):
+        if not self._cancelled:
+            self.function(*self.args, **self.kwargs)
+
+
+class VirtualRepeatedTimer(object):
+    """OctoPrint's RepeatedTimer firing on the virtual clock."""
+
+    def __init__(
+        self, clock, interval, function, args=None, kwargs=None, run_first=False, **_
+    ):
+        self._clock = clock
+        self._interval = interval
+        self._function = function
+        self._args = args or []
+        self._kwargs = kwargs or {}
+        self._run_first = run_first
+        self._started = False
+        self._cancelled = False
+
+    def start(self):
+        # Same contract as a thread, it can only be started once
+        if self._started:
+            raise RuntimeError("threads can only be started once")
+        self._started = True
+        self._schedule(0 if self._run_first else None)
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_alive(self):
+        return self._started and not self._cancelled
+
+    def _schedule(self, delay=None):
+        if delay is None:
+            delay = self._interval() if callable(self._interval) else self._interval
+        self._clock.call_later(delay, self._fire)
+
+    def _fire(self):
+        if self._cancelled:
+            return
+        self._function(*self._args, **self._kwargs)
+        if not self._cancelled:
+            self._schedule()
+
+
+class InlineThread(object):
+    """threading.Thread running its target as soon as it is started."""
+
+    def __init__(self, target=None, name=None, args=(), kwargs=None):
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs or {}
+        self.name = name
+        self.daemon = True
+
+    def start(self):
+        self._target(*self._args, **self._kwargs)
+
+    def is_alive(self):
+        return False
+
+
+class VirtualThreading(object):
+    """Replacement for the threading module as seen by the plugin module."""
+
+    def __init__(self, clock):
+        self._clock = clock
+
+    def Timer(self, interval, function, args=None, kwargs=None):
+        return VirtualTimer(self._clock, interval, function, args, kwargs)
+
+    def Thread(self, target=None, name=None, args=(), kwargs=None):
+        return InlineThread(target, name, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(threading, name)
+
+
+def install_clock(clock):
+    for module in PLUGIN_MODULES:
+        module.time = clock
+    octoprint_homeassistant.threading = VirtualThreading(clock)
+    octoprint_homeassistant.RepeatedTimer = lambda *args, **kwargs: VirtualRepeatedTimer(
+        clock, *args, **kwargs
+    )
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    """Serves the capture as the camera snapshot."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(self.server.snapshot)))
+        self.end_headers()
+        self.wfile.write(self.server.snapshot)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_streamer(capture):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SnapshotHandler)
+    server.daemon_threads = True
+    with open(capture, "rb") as f:
+        server.snapshot = f.read()
+    _thread = threading.Thread(target=server.serve_forever)
+    _thread.daemon = True
+    _thread.start()
+    return server
+
+
+def traced_plugin_memory():
+    # Only count what the plugin allocated, not the harness and its samples
+    _snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, "*%soctoprint_homeassistant%s*" % (os.sep, os.sep))]
+    )
+    return sum(stat.size for stat in _snapshot.statistics("filename"))
+
+
+class LatencyRecorder(object):
+    """Wraps PublishWorker.submit to measure the hand-off to publish latency."""
+
+    def __init__(self, worker):
+        self.samples = []
+        self._submit = worker.submit
+        worker.submit = self.submit
+
+    def submit(self, publish_class, topic, payload, publish, **kwargs):
+        _start = time.perf_counter()
+
+        def timed_publish(*args, **kw):
+            self.samples.append(time.perf_counter() - _start)
+            return publish(*args, **kw)
+
+        return self._submit(publish_class, topic, payload, timed_publish, **kwargs)
+
+    def percentiles(self, *points):
+        _samples = sorted(self.samples)
+        if not _samples:
+            return dict((p, 0.0) for p in points)
+        return dict(
+            (p, _samples[min(len(_samples) - 1, int(len(_samples) * p / 100.0))])
+            for p in points
+        )
+
+
+def write_capture(path):
+    try:
+        from PIL import Image
+
+        Image.new("RGB", (1920, 1080), (40, 40, 40)).save(path, format="JPEG")
+    except ImportError:
+        with open(path, "wb") as f:
+            f.write(b"\xff\xd8" + os.urandom(256 * 1024) + b"\xff\xd9")
+
+
+class OfflineRecorder(object):
+    """Tracks broker outages and how much the offline buffer held."""
+
+    def __init__(self, worker):
+        self._worker = worker
+        self.outages = 0
+        self.max_buffered = 0
+        self.max_bytes = 0
+
+    def sample(self):
+        _offline = self._worker.offline()
+        self.max_buffered = max(self.max_buffered, _offline["buffered"])
+        self.max_bytes = max(self.max_bytes, _offline["bytes"])
+
+
+def simulate_print(plugin, mqtt, clock, args, capture, offline, on_hour):
+    printer = plugin._printer
+    worker = plugin._publish_worker
+    step = args.step
+    _duration = args.hours * 3600
+    _birth = plugin._settings.get(["discovery_topic"]) + "/status"
+    _camera = plugin._generate_topic("controlTopic", "camera_snapshot", full=True)
+    _next = collections.defaultdict(float)
+    _reconnect_at = None
+
+    def due(name, interval, elapsed):
+        if elapsed >= _next[name]:
+            _next[name] = elapsed + interval
+            return True
+        return False
+
+    printer.printing = True
+    printer.progress = 0.0
+    plugin.on_event(Events.PRINT_STARTED, {})
+
+    elapsed = 0.0
+    while elapsed < _duration:
+        # Fires the plugin's timers that are due
+        clock.advance(step)
+        elapsed += step
+        _completion = min(100.0, elapsed * 100.0 / _duration)
+
+        # Heaters report every couple of seconds with a bit of noise
+        _noise = (int(elapsed) % 7 - 3) * 0.1
+        plugin.on_temperatures_received(
+            None, {"T0": (210.0 + _noise, 210.0), "B": (60.0 + _noise / 2, 60.0)}
+        )
+
+        if int(_completion) > int(printer.progress):
+            printer.progress = _completion
+            plugin.on_print_progress("local", "benchy.gcode", int(_completion))
+        else:
+            printer.progress = _completion
+
+        if due("layer", 60, elapsed):
+            printer.z = round(printer.z + 0.2, 2)
+            plugin.on_event(Events.Z_CHANGE, {"new": printer.z, "old": printer.z - 0.2})
+
+        if due("capture", 300, elapsed):
+            plugin.on_event(Events.CAPTURE_DONE, {"file": capture})
+
+        if due("snapshot", 420, elapsed):
+            mqtt.deliver(_camera, "PRESS")
+
+        # Pause for ten minutes at a third and two thirds of the print
+        if not printer.paused and int(elapsed) in (_duration // 3, 2 * _duration // 3):
+            printer.paused = True
+            plugin.on_event(Events.PRINT_PAUSED, {})
+        elif printer.paused and due("resume", 600, elapsed):
+            printer.paused = False
+            plugin.on_event(Events.PRINT_RESUMED, {})
+
+        # The broker goes away for a while, Home Assistant announces itself
+        # again once it is back
+        if due("outage", 3 * 3600, elapsed) and elapsed > step:
+            mqtt.connected = False
+            offline.outages += 1
+            _reconnect_at = elapsed + args.outage
+        elif _reconnect_at is not None and elapsed >= _reconnect_at:
+            mqtt.connected = True
+            _reconnect_at = None
+            mqtt.deliver(_birth, "online")
+
+        if due("settings", 4 * 3600, elapsed) and elapsed > step:
+            plugin.on_settings_save({})
+
+        worker.run_pending()
+        offline.sample()
+
+        if due("hour", 3600, elapsed):
+            on_hour(elapsed / 3600.0)
+
+    if _reconnect_at is not None:
+        mqtt.connected = True
+        mqtt.deliver(_birth, "online")
+
+    printer.printing = False
+    plugin.on_event(Events.PRINT_DONE, {})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hours", type=float, default=24, help="simulated print duration")
+    parser.add_argument("--prints", type=int, default=1, help="number of prints to replay")
+    parser.add_argument("--step", type=float, default=2.0, help="simulated seconds per step")
+    parser.add_argument(
+        "--outage", type=float, default=600, help="seconds the broker is away every 3 hours"
+    )
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        help="fail when tracemalloc grows by more than this many KiB after the first print",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    clock = VirtualClock()
+    install_clock(clock)
+
+    capture = os.path.join(tempfile.mkdtemp(), "capture.jpg")
+    write_capture(capture)
+    streamer = start_streamer(capture)
+
+    plugin, mqtt = create_plugin(
+        extruders=1,
+        snapshot="http://127.0.0.1:%d/?action=snapshot" % streamer.server_address[1],
+    )
+    # The worker is drained by the simulation instead
+    worker = plugin._publish_worker
+    worker.stop(timeout=5)
+    worker.run_pending()
+    latency = LatencyRecorder(worker)
+    offline = OfflineRecorder(worker)
+
+    process = psutil.Process()
+    memory = []
+
+    def on_hour(hour):
+        gc.collect()
+        memory.append((hour, process.memory_info().rss, traced_plugin_memory()))
+
+    tracemalloc.start()
+    _start = time.perf_counter()
+    _start_clock = clock.monotonic()
+    _after_first = None
+    try:
+        for i in range(args.prints):
+            simulate_print(plugin, mqtt, clock, args, capture, offline, on_hour)
+            if i == 0:
+                gc.collect()
+                _after_first = traced_plugin_memory()
+        # Let the publish worker flush what is left before counting
+        while worker.pending() and clock.monotonic() < _start_clock + 3600:
+            clock.advance(args.step)
+            worker.run_pending()
+    finally:
+        _wall = time.perf_counter() - _start
+        gc.collect()
+        _final = traced_plugin_memory()
+        tracemalloc.stop()
+        stop_plugin(plugin)
+        streamer.shutdown()
+        streamer.server_close()
+
+    _percentiles = latency.percentiles(50, 90, 99, 99.9)
+    report = {
+        "simulated_hours": args.hours * args.prints,
+        "wall_seconds": _wall,
+        "messages": sum(mqtt.messages.values()),
+        "bytes": sum(mqtt.bytes.values()),
+        "topics": dict(
+            (t, {"messages": mqtt.messages[t], "bytes": mqtt.bytes[t]})
+            for t in mqtt.messages
+        ),
+        "latency_ms": dict(("p%s" % p, v * 1000) for p, v in _percentiles.items()),
+        "offline": {
+            "outages": offline.outages,
+            "max_buffered": offline.max_buffered,
+            "max_bytes": offline.max_bytes,
+            "dropped": dict(worker.dropped),
+        },
+        "rss_bytes": [m[1] for m in memory],
+        "traced_bytes": [m[2] for m in memory],
+        "traced_growth_after_first_print": _final - (_after_first or _final),
+    }
+
+    print(
+        "Simulated %.0f h in %.1f s: %d messages, %d bytes"
+        % (report["simulated_hours"], _wall, report["messages"], report["bytes"])
+    )
+    print()
+    print("%-60s %10s %12s" % ("topic", "messages", "bytes"))
+    for topic in sorted(mqtt.messages, key=lambda t: -mqtt.bytes[t]):
+        print("%-60s %10d %12d" % (topic, mqtt.messages[topic], mqtt.bytes[topic]))
+    print()
+    print(
+        "Publish latency: "
+        + ", ".join("p%s %.3f ms" % (p, v * 1000) for p, v in sorted(_percentiles.items()))
+    )
+    print(
+        "Offline: %d outages, up to %d messages / %.1f KiB buffered, dropped %s"
+        % (
+            offline.outages,
+            offline.max_buffered,
+            offline.max_bytes / 1024.0,
+            dict(worker.dropped),
+        )
+    )
+    if memory:
+        print(
+            "RSS: %.1f MiB -> %.1f MiB, traced: %.1f KiB -> %.1f KiB"
+            % (
+                memory[0][1] / 1048576.0,
+                memory[-1][1] / 1048576.0,
+                memory[0][2] / 1024.0,
+                memory[-1][2] / 1024.0,
+            )
+        )
+    print(
+        "Traced growth after the first print: %.1f KiB"
+        % (report["traced_growth_after_first_print"] / 1024.0)
+    )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if (
+        args.max_growth is not None
+        and report["traced_growth_after_first_print"] > args.max_growth * 1024
+    ):
+        print("Memory grew by more than %.1f KiB" % args.max_growth)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,16 @@
 from __future__ import absolute_import
 
 import datetime
+import functools
+import glob
+import io
 import json
 import logging
+import os
 import re
+import socket
+import threading
+import time
 
 import psutil
 import octoprint.plugin
@@ -12,6 +19,50 @@ from octoprint.events import Events
 from octoprint.settings import settings
 from octoprint.util import RepeatedTimer
 
+from .commands import CommandQueue, parse_commands
+from .entities import (
+    CONTROL_ENTITIES,
+    SENSOR_ENTITIES,
+    Topic,
+    compile_device,
+    compile_entities,
+    referenced_fields,
+    split_fields,
+)
+from .publisher import (
+    PUBLISH_COMMAND,
+    PUBLISH_DISCOVERY,
+    PUBLISH_STATE,
+    PUBLISH_TELEMETRY,
+    PublishWorker,
+)
+from .util import (
+    AdaptiveInterval,
+    Metrics,
+    RingBuffer,
+    TokenBucket,
+    compile_projection,
+    node_jitter,
+)
+
+# Candidate SoC temperature sensors, in order of preference, as named by hwmon
+# and thermal zones (and psutil, which reads the same sources).
+CPU_TEMP_SENSORS = ("coretemp", "cpu-thermal", "cpu_thermal", "x86_pkg_temp")
+
+# Raspberry Pi firmware throttling flags, current state in the low bits and
+# "has occurred since boot" in bits 16-19.
+RPI_THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+THROTTLED_FLAGS = dict(
+    under_voltage=0x1,
+    freq_capped=0x2,
+    throttled=0x4,
+    soft_temp_limit=0x8,
+    under_voltage_occurred=0x10000,
+    freq_capped_occurred=0x20000,
+    throttled_occurred=0x40000,
+    soft_temp_limit_occurred=0x80000,
+)
+
 SETTINGS_DEFAULTS = dict(
     unique_id=None,
     node_id=None,
@@ -19,6 +70,49 @@ SETTINGS_DEFAULTS = dict(
     node_name="OctoPrint",
     device_manufacturer="Clifford Roche",
     device_model="HomeAssistant Discovery for OctoPrint",
+    status_thresholds=dict(),
+    status_projection=False,
+    status_extra_fields=[],
+    status_split_topics=False,
+    status_coalesce_window=0.5,
+    status_coalesce_max_latency=2.0,
+    publish_queue_size=100,
+    offline_buffer_size=262144,
+    offline_flush_rate=20,
+    snapshot_timeout=5,
+    camera_max_width=1920,
+    camera_max_height=1080,
+    camera_jpeg_quality=80,
+    camera_max_bytes=1048576,
+    camera_thumbnail_size=0,
+    temperature_deadband=0.5,
+    temperature_min_interval=5,
+    temperature_heartbeat=60,
+    history_size=600,
+    history_window=300,
+    history_interval=60,
+    host_metrics=dict(
+        soc_temperature=30,
+        cpu_load=30,
+        memory=60,
+        disk_free=300,
+        throttled=60,
+    ),
+    update_interval_min=60,
+    update_interval_max=120,
+    host_interval_min=30,
+    host_interval_max=300,
+    host_change_ratio=0.1,
+    diagnostic_sensors=False,
+    command_chunk_size=10,
+    command_rate=20,
+    command_queue_size=1000,
+    jog_coalesce_window=0.2,
+    jog_max_distance=50,
+    discovery_mode="entity",
+    rediscovery_jitter=15,
+    discovery_rate=10,
+    discovery_burst=10,
 )
 
 MQTT_DEFAULTS = dict(
@@ -33,35 +127,214 @@ MQTT_DEFAULTS = dict(
     )
 )
 
+# Control topic suffix -> (handler, accepted payloads). A payload of "json" is
+# parsed before dispatch, None passes the decoded string through unchecked.
+CONTROL_ROUTES = dict(
+    connect=("_on_connect_printer", ("True", "False")),
+    stop=("_on_emergency_stop", ("PRESS",)),
+    cancel=("_on_cancel_print", ("PRESS",)),
+    pause=("_on_pause_print", ("True", "False")),
+    shutdown=("_on_shutdown_system", ("PRESS",)),
+    reboot=("_on_restart_system", ("PRESS",)),
+    restart=("_on_restart_server", ("PRESS",)),
+    psu=("_on_psu", ("True", "False")),
+    camera_snapshot=("_on_camera", ("PRESS", "True", "False")),
+    jog=("_on_jog", "json"),
+    home=("_on_home", "json"),
+    commands=("_on_command", None),
+)
+
+
+def instrumented(func):
+    """Records the duration of every call in the plugin metrics."""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        _start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._metrics.record_handler(func.__name__, time.perf_counter() - _start)
+
+    return wrapper
+
 
 class HomeassistantPlugin(
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.ProgressPlugin,
     octoprint.plugin.WizardPlugin,
+    octoprint.plugin.SimpleApiPlugin,
 ):
     def __init__(self):
         self._logger = logging.getLogger(__name__)
         self.mqtt_publish = None
         self.mqtt_publish_with_timestamp = None
         self.mqtt_subcribe = None
+        self.mqtt_unsubscribe = None
         self.update_timer = None
         self.constant_timer = None
+        self.history_timer = None
         self.psucontrol_enabled = False
+        self.snapshot_enabled = False
+        self.snapshot_path = None
+        self._discovery_cache = {}
+        self._compiled_entities = {}
+        self._state_lock = threading.Lock()
+        self._state_cache = {}
+        self._state_cache_table = None
+        self._discovery_bucket = TokenBucket(10, 10)
+        self._flush_bucket = TokenBucket(20, 20)
+        self._rediscovery_lock = threading.Lock()
+        self._rediscovery_timer = None
+        self._rediscovery_jitter = 0
+        self._topic_table = None
+        self._topic_cache = {}
+        self._status_lock = threading.Lock()
+        self._status_snapshot = None
+        self._status_thresholds = {}
+        self._status_projection = None
+        self._status_split = []
+        self._status_split_published = {}
+        self._status_window = 0
+        self._status_max_latency = 0
+        self._coalesce_lock = threading.Lock()
+        self._coalesce_timer = None
+        self._coalesce_generation = 0
+        self._coalesce_started = 0
+        self._status_triggers = 0
+        self._status_merged = 0
+        self._publish_worker = None
+        self._command_queue = None
+        self._jog_lock = threading.Lock()
+        self._jog_timer = None
+        self._jog_generation = 0
+        self._jog_pending = {}
+        self._jog_speed = None
+        self._jog_window = 0
+        self._jog_max_distance = 0
+        self._metrics = Metrics()
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_busy = False
+        self._snapshot_pending = None
+        self._snapshot_conn = None
+        self._temperatures = {}
+        self._temperature_deadband = 0
+        self._temperature_min_interval = 0
+        self._temperature_heartbeat = 0
+        self._history_lock = threading.Lock()
+        self._history = {}
+        self._history_size = 0
+        self._history_window = 0
+        self._history_interval = 60
+        self._history_published = {}
+        self._cpu_temp_path = None
+        self._cpu_temp_sensor = None
+        self._throttled_source = None
+        self._host_sampled = {}
+        self._host_values = {}
+        self._update_cadence = AdaptiveInterval(60, 120)
+        self._host_cadence = AdaptiveInterval(30, 300)
+        self._host_change_ratio = 0.1
+        self._published_cadence = None
+        self._published_cadence_time = 0
+        self._subscription_lock = threading.Lock()
+        self._subscriptions = {}
 
     def handle_timer(self):
-        self._generate_printer_status()
+        _changed = self._generate_printer_status()
+        self._update_cadence.update(_changed)
 
     def handle_constant_timer(self):
-        self._generate_status()
+        _changed = self._generate_status()
+        self._host_cadence.update(_changed, busy=self._printer.is_printing())
+        self._generate_cadence()
+        self._generate_diagnostics()
+
+    def _create_update_timer(self):
+        return RepeatedTimer(
+            self._update_cadence.current, self.handle_timer, None, None, False
+        )
 
     ##~~ SettingsPlugin
 
     def get_settings_defaults(self):
         return SETTINGS_DEFAULTS
 
+    def _load_tunables(self):
+        self._status_thresholds = self._settings.get(["status_thresholds"]) or {}
+        self._status_projection = None
+        if self._settings.get_boolean(["status_projection"]):
+            # Only publish the fields the discovery templates actually read
+            _fields = referenced_fields(
+                SENSOR_ENTITIES + CONTROL_ENTITIES, Topic("hassTopic", "printing")
+            )
+            _fields.update(self._settings.get(["status_extra_fields"]) or [])
+            self._status_projection = compile_projection(_fields)
+
+        # Scalar status fields published to topics of their own
+        _split = []
+        if self._settings.get_boolean(["status_split_topics"]):
+            _split = sorted(
+                split_fields(
+                    SENSOR_ENTITIES + CONTROL_ENTITIES, Topic("hassTopic", "printing")
+                )
+            )
+        with self._status_lock:
+            self._status_split = _split
+            self._status_split_published = {}
+            # The published topics or fields may have changed, the next status
+            # must go out even when the printer is idle
+            self._status_snapshot = None
+        self._status_window = float(self._settings.get(["status_coalesce_window"]))
+        self._status_max_latency = float(
+            self._settings.get(["status_coalesce_max_latency"])
+        )
+        self._temperature_deadband = float(self._settings.get(["temperature_deadband"]))
+        self._temperature_min_interval = float(
+            self._settings.get(["temperature_min_interval"])
+        )
+        self._temperature_heartbeat = float(
+            self._settings.get(["temperature_heartbeat"])
+        )
+        _history_size = self._settings.get_int(["history_size"])
+        with self._history_lock:
+            if _history_size != self._history_size:
+                self._history = {}
+                self._history_published = {}
+            self._history_size = _history_size
+        self._history_window = self._settings.get_float(["history_window"])
+        self._history_interval = max(
+            1.0, self._settings.get_float(["history_interval"])
+        )
+        self._update_cadence.configure(
+            self._settings.get_float(["update_interval_min"]),
+            self._settings.get_float(["update_interval_max"]),
+        )
+        self._host_cadence.configure(
+            self._settings.get_float(["host_interval_min"]),
+            self._settings.get_float(["host_interval_max"]),
+        )
+        self._host_change_ratio = self._settings.get_float(["host_change_ratio"])
+        self._rediscovery_jitter = self._settings.get_float(["rediscovery_jitter"])
+        self._discovery_bucket.configure(
+            self._settings.get_float(["discovery_rate"]),
+            self._settings.get_float(["discovery_burst"]),
+        )
+        _flush_rate = self._settings.get_float(["offline_flush_rate"])
+        self._flush_bucket.configure(_flush_rate, _flush_rate)
+        self._jog_window = self._settings.get_float(["jog_coalesce_window"])
+        self._jog_max_distance = self._settings.get_float(["jog_max_distance"])
+        if self._command_queue:
+            self._command_queue.configure(
+                self._settings.get_int(["command_chunk_size"]),
+                self._settings.get_float(["command_rate"]),
+                self._settings.get_int(["command_queue_size"]),
+            )
+
     def get_settings_version(self):
         return 2
 
@@ -74,10 +347,18 @@ class HomeassistantPlugin(
 
     def on_settings_save(self, data):
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._invalidate_topic_table()
+        self._load_tunables()
+
+        # Remove the configs left behind by a change of discovery mode, node
+        # or discovery topic, or by entities that were disabled. They are
+        # cleared first so Home Assistant doesn't see duplicate unique ids.
+        self._clear_discovery(set(self._discovery_cache) - self._get_discovery_topics())
 
         self._generate_device_registration()
         self._generate_device_controls(subscribe=True)
         self._generate_connection_status()
+        self._generate_printer_status()
 
     ##~~ TemplatePlugin mixin
 
@@ -96,8 +377,30 @@ class HomeassistantPlugin(
             self._settings.set(["node_id"], _uuid.hex)
             settings().save()
 
+        self._command_queue = CommandQueue(
+            send=self._printer.commands,
+            report=self._generate_command_status,
+            logger=self._logger,
+        )
+        self._load_tunables()
+
+        self._publish_worker = PublishWorker(
+            max_size=self._settings.get_int(["publish_queue_size"]),
+            logger=self._logger,
+            metrics=self._metrics,
+            offline_max_bytes=self._settings.get_int(["offline_buffer_size"]),
+            flush_bucket=self._flush_bucket,
+        )
+        self._publish_worker.set_rate_limit(PUBLISH_DISCOVERY, self._discovery_bucket)
+        self._publish_worker.start()
+        self._command_queue.start()
+
         helpers = self._plugin_manager.get_helpers(
-            "mqtt", "mqtt_publish", "mqtt_publish_with_timestamp", "mqtt_subscribe"
+            "mqtt",
+            "mqtt_publish",
+            "mqtt_publish_with_timestamp",
+            "mqtt_subscribe",
+            "mqtt_unsubscribe",
         )
         if helpers:
             if "mqtt_publish_with_timestamp" in helpers:
@@ -113,9 +416,24 @@ class HomeassistantPlugin(
             if "mqtt_subscribe" in helpers:
                 self._logger.debug("Setup subscribe helper")
                 self.mqtt_subscribe = helpers["mqtt_subscribe"]
-                self.mqtt_subscribe(
-                    self._generate_topic("lwTopic", "", full=True),
-                    self._on_mqtt_message,
+
+            if "mqtt_unsubscribe" in helpers:
+                self._logger.debug("Setup unsubscribe helper")
+                self.mqtt_unsubscribe = helpers["mqtt_unsubscribe"]
+
+            # Our temperature stream replaces the MQTT plugin's, which publishes
+            # every temperature report when it is left enabled
+            _temperature_defaults = dict(
+                plugins=dict(mqtt=dict(publish=dict(temperatureActive=True)))
+            )
+            if settings().getBoolean(
+                ["plugins", "mqtt", "publish", "temperatureActive"],
+                defaults=_temperature_defaults,
+            ):
+                self._logger.warning(
+                    "The MQTT plugin also publishes every temperature report, "
+                    "set plugins.mqtt.publish.temperatureActive to false to "
+                    "only send the deadbanded temperatures of this plugin"
                 )
 
         # PSUControl helpers
@@ -167,32 +485,49 @@ class HomeassistantPlugin(
                 self.snapshot_enabled = False
 
         if not self.update_timer:
-            self.update_timer = RepeatedTimer(60, self.handle_timer, None, None, False)
+            self.update_timer = self._create_update_timer()
+
+        self._resolve_host_sensors()
 
         if not self.constant_timer:
             self.constant_timer = RepeatedTimer(
-                30, self.handle_constant_timer, None, None, False
+                self._host_cadence.current,
+                self.handle_constant_timer,
+                None,
+                None,
+                False,
             )
             self.constant_timer.start()
 
+        if not self.history_timer:
+            self.history_timer = RepeatedTimer(
+                lambda: self._history_interval,
+                self._generate_history,
+                None,
+                None,
+                False,
+            )
+            self.history_timer.start()
+
         # Since retain may not be used it's not always possible to simply tie this to the connected state
+        # Controls are subscribed here, after the PSU and snapshot setup their handlers read
         self._generate_device_registration()
         self._generate_device_controls(subscribe=True)
 
         # For people who do not have retain setup, need to do this again to make sensors available
         _connected_topic = self._generate_topic("lwTopic", "", full=True)
-        self.mqtt_publish(_connected_topic, "connected", allow_queueing=True)
+        self._publish(PUBLISH_STATE, _connected_topic, "connected", replay=False)
 
         # Setup the default printer states
-        self.mqtt_publish(
+        self._publish(
+            PUBLISH_STATE,
             self._generate_topic("hassTopic", "is_printing", full=True),
             "False",
-            allow_queueing=True,
         )
-        self.mqtt_publish(
+        self._publish(
+            PUBLISH_STATE,
             self._generate_topic("hassTopic", "is_paused", full=True),
             "False",
-            allow_queueing=True,
         )
         self.on_print_progress("", "", 0)
         self._generate_connection_status()
@@ -200,11 +535,92 @@ class HomeassistantPlugin(
         if self.psucontrol_enabled:
             self._generate_psu_state()
 
+    ##~~ ShutdownPlugin mixin
+
+    def on_shutdown(self):
+        for timer in (self.update_timer, self.constant_timer, self.history_timer):
+            if timer:
+                timer.cancel()
+        with self._rediscovery_lock:
+            if self._rediscovery_timer is not None:
+                self._rediscovery_timer.cancel()
+                self._rediscovery_timer = None
+        with self._coalesce_lock:
+            if self._coalesce_timer is not None:
+                self._coalesce_timer.cancel()
+                self._coalesce_timer = None
+            self._coalesce_generation += 1
+        self._cancel_jog()
+        if self._command_queue:
+            self._command_queue.stop(timeout=5)
+        if self._publish_worker:
+            self._publish_worker.stop(timeout=5)
+
+    def _publish(
+        self, publish_class, topic, payload, timestamp=False, replay=True, **kwargs
+    ):
+        # Helpers are only available after on_after_startup, events can arrive sooner
+        _publish = self.mqtt_publish_with_timestamp if timestamp else self.mqtt_publish
+        if not _publish or not self._publish_worker:
+            return
+
+        # The MQTT plugin would queue every message while disconnected, the
+        # publish worker keeps a bounded last value per topic instead.
+        kwargs["allow_queueing"] = False
+
+        # Keep the last value of every topic to replay it after a reconnect,
+        # camera images are too large and go stale quickly anyway. The LWT
+        # topic is owned by the MQTT plugin and never replayed.
+        if replay and not kwargs.get("raw_data"):
+            with self._state_lock:
+                self._state_cache[topic] = (
+                    publish_class,
+                    payload,
+                    time.time() if timestamp else None,
+                    kwargs,
+                )
+
+        self._publish_worker.submit(publish_class, topic, payload, _publish, **kwargs)
+
+    def _replay_state(self):
+        # Publishes the cached states in one batch, without asking the printer
+        if not self._publish_worker:
+            return
+
+        with self._state_lock:
+            _cached = list(self._state_cache.items())
+
+        _entries = []
+        for topic, (publish_class, payload, timestamp, kwargs) in _cached:
+            if timestamp is None:
+                _entries.append((publish_class, topic, payload, self.mqtt_publish, kwargs))
+            else:
+                _entries.append(
+                    (
+                        publish_class,
+                        topic,
+                        payload,
+                        self.mqtt_publish_with_timestamp,
+                        dict(kwargs, timestamp=timestamp),
+                    )
+                )
+        self._logger.debug("Replaying %d cached states", len(_entries))
+        self._publish_worker.submit_entries(_entries)
+
+    def _publish_many(self, publish_class, messages, **kwargs):
+        if not self.mqtt_publish or not self._publish_worker:
+            return
+
+        self._publish_worker.submit_many(
+            publish_class, messages, self.mqtt_publish, allow_queueing=False, **kwargs
+        )
+
     def _get_mac_address(self):
         import uuid
 
         return ":".join(re.findall("..", "%012x" % uuid.getnode()))
 
+    @instrumented
     def _on_mqtt_message(
         self, topic, message, retained=None, qos=None, *args, **kwargs
     ):
@@ -218,396 +634,215 @@ class HomeassistantPlugin(
 
         # Don't rely on this, the message may be disabled.
         if message == "connected":
-            self._generate_device_registration()
-            self._generate_device_controls(subscribe=False)
+            # The MQTT plugin reconnected, the broker may have lost its
+            # retained configs. The LWT topic is never replayed, so the
+            # rediscovery doesn't trigger itself again.
+            self._schedule_rediscovery()
 
-    def _generate_topic(self, topic_type, topic, full=False):
-        self._logger.debug("Generating topic for " + topic_type + ", " + topic)
+    @instrumented
+    def _on_ha_status(self, topic, message, retained=None, qos=None, *args, **kwargs):
+        try:
+            message = message.decode()
+        except (UnicodeDecodeError, AttributeError):
+            pass
+
+        self._logger.debug("Home Assistant status: " + str(message))
+        if message == "online":
+            # Home Assistant restarted and needs the configs again
+            self._schedule_rediscovery()
+
+    def _schedule_rediscovery(self):
+        # Every node waits for its own share of the jitter window, so a fleet
+        # doesn't republish all at once when the broker or Home Assistant
+        # restart. Triggers while one is pending are merged into it.
+        _delay = node_jitter(self._settings.get(["node_id"]), self._rediscovery_jitter)
+        with self._rediscovery_lock:
+            if self._rediscovery_timer is not None:
+                return
+            self._logger.debug("Rediscovery scheduled in %.1f s", _delay)
+            self._rediscovery_timer = threading.Timer(_delay, self._rediscover)
+            self._rediscovery_timer.daemon = True
+            self._rediscovery_timer.start()
+
+    def _rediscover(self):
+        with self._rediscovery_lock:
+            self._rediscovery_timer = None
+
+        # Force a full resync, the publish worker rate limits the configs. The
+        # cache is kept, it still tracks the configs to remove later on.
+        self._generate_device_registration(force=True)
+        self._generate_device_controls(subscribe=False, force=True)
+
+        # States of entities Home Assistant doesn't know about yet are dropped
+        # when they aren't retained, so wait for the configs to go out first.
+        if self._publish_worker:
+            self._publish_worker.wait_drained(PUBLISH_DISCOVERY, timeout=60)
+        self._replay_state()
+
+    def _build_topic_table(self):
         mqtt_defaults = dict(plugins=dict(mqtt=MQTT_DEFAULTS))
-        _topic = ""
+        _table = {}
 
-        if topic_type != "baseTopic":
+        for topic_type in MQTT_DEFAULTS["publish"]:
             _topic = settings().get(
                 ["plugins", "mqtt", "publish", topic_type], defaults=mqtt_defaults
             )
-            _topic = re.sub(r"{.+}", "", _topic)
-
-        if full or topic_type == "baseTopic":
-            _topic = (
-                settings().get(
-                    ["plugins", "mqtt", "publish", "baseTopic"], defaults=mqtt_defaults
-                )
-                + _topic
-            )
-
-        _topic += topic
-        self._logger.debug("Generated topic: " + _topic)
-        return _topic
-
-    def _generate_device_registration(self):
-
-        _discovery_topic = self._settings.get(["discovery_topic"])
-
-        _node_name = self._settings.get(["node_name"])
-        _node_id = self._settings.get(["node_id"])
-
-        _device_manufacturer = self._settings.get(["device_manufacturer"])
-        _device_model = self._settings.get(["device_model"])
+            if topic_type != "baseTopic":
+                _topic = re.sub(r"{.+}", "", _topic)
+            _table[topic_type] = _topic
 
-        _config_device = self._generate_device_config(
-            _node_id, _node_name, _device_manufacturer, _device_model
-        )
+        self._logger.debug("Resolved MQTT topic table: %s", _table)
+        return _table
 
-        ##~~ Configure Connected Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/binary_sensor/" + _node_id + "_CONNECTED/config",
-            values={
-                "name": "Connected",
-                "uniq_id": _node_id + "_CONNECTED",
-                "stat_t": "~" + self._generate_topic("hassTopic", "Connected"),
-                "pl_on": "Connected",
-                "pl_off": "Disconnected",
-                "dev_cla": "connectivity",
-                "device": _config_device,
-            },
-        )
-
-        ##~~ Configure Printing Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/binary_sensor/" + _node_id + "_PRINTING/config",
-            values={
-                "name": "Printing",
-                "uniq_id": _node_id + "_PRINTING",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "pl_on": "True",
-                "pl_off": "False",
-                "val_tpl": "{{value_json.state.flags.printing}}",
-                "device": _config_device,
-            },
-        )
+    def _invalidate_topic_table(self):
+        self._topic_table = None
+        self._topic_cache = {}
+        self._compiled_entities = {}
 
-        ##~~ Configure Last Event Sensor
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_EVENT/config",
-            values={
-                "name": "Last event",
-                "uniq_id": _node_id + "_EVENT",
-                "stat_t": "~" + self._generate_topic("eventTopic", "+"),
-                "val_tpl": "{{value_json._event}}",
-                "device": _config_device,
-            },
-        )
+    def _generate_topic(self, topic_type, topic, full=False):
+        _key = (topic_type, topic, full)
+        _topic = self._topic_cache.get(_key)
+        if _topic is not None:
+            return _topic
+
+        _table = self._topic_table
+        if _table is None:
+            _table = self._topic_table = self._build_topic_table()
+            if _table != self._state_cache_table:
+                # Cached states were published to topics that are gone
+                with self._state_lock:
+                    self._state_cache.clear()
+                    self._state_cache_table = _table
 
-        ##~~ Configure Print Status
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_S/config",
-            values={
-                "name": "Print status",
-                "uniq_id": _node_id + "_PRINTING_S",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.state|tojson}}",
-                "val_tpl": "{{value_json.state.text}}",
-                "device": _config_device,
-            },
-        )
+        _topic = ""
+        if topic_type != "baseTopic":
+            _topic = _table[topic_type]
 
-        ##~~ Configure Print Progress
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_P/config",
-            values={
-                "name": "Print progress",
-                "uniq_id": _node_id + "_PRINTING_P",
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.progress|tojson}}",
-                "stat_t": "~" + self._generate_topic("progressTopic", "printing"),
-                "unit_of_meas": "%",
-                "val_tpl": "{{value_json.progress|float(0)}}",
-                "device": _config_device,
-            },
-        )
+        if full or topic_type == "baseTopic":
+            _topic = _table["baseTopic"] + _topic
 
-        ##~~ Configure Print File
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_F/config",
-            values={
-                "name": "Print file",
-                "uniq_id": _node_id + "_PRINTING_F",
-                "stat_t": "~" + self._generate_topic("progressTopic", "printing"),
-                "val_tpl": "{{value_json.path}}",
-                "device": _config_device,
-                "ic": "mdi:file",
-            },
-        )
+        _topic += topic
+        self._logger.debug("Generated topic for %s, %s: %s", topic_type, topic, _topic)
+        self._topic_cache[_key] = _topic
+        return _topic
 
-        ##~~ Configure Print Time
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_T/config",
-            values={
-                "name": "Print time",
-                "uniq_id": _node_id + "_PRINTING_T",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "printing"),
-                        "val_tpl": "{{'False' if not value_json.progress.printTime else 'True'}}",
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    }
-                ],
-                "val_tpl": "{{value_json.progress.printTime}}",
-                "dev_cla": "duration",
-                "unit_of_meas": "s",
-                "device": _config_device,
-                "ic": "mdi:clock-start",
-            },
-        )
+    def _generate_device_registration(self, force=False):
+        # In device mode a single config holds both the sensors and controls
+        if self._is_device_discovery():
+            self._publish_entities(self._compile_device(), force=force)
+        else:
+            self._publish_entities(
+                self._compile_entities("sensors", SENSOR_ENTITIES), force=force
+            )
 
-        ##~~ Configure Print Time Left
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_E/config",
-            values={
-                "name": "Print time left",
-                "uniq_id": _node_id + "_PRINTING_E",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "printing"),
-                        "val_tpl": "{{'False' if not value_json.progress.printTimeLeft else 'True'}}",
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    }
-                ],
-                "val_tpl": "{{value_json.progress.printTimeLeft}}",
-                "dev_cla": "duration",
-                "unit_of_meas": "s",
-                "device": _config_device,
-                "ic": "mdi:clock-end",
-            },
-        )
+    def _is_device_discovery(self):
+        return self._settings.get(["discovery_mode"]) == "device"
 
-        ##~~ Configure Print ETA
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_ETA/config",
-            values={
-                "name": "Approximate total print time",
-                "uniq_id": _node_id + "_PRINTING_ETA",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "json_attr_tpl": "{{value_json.job|tojson}}",
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "printing"),
-                        "val_tpl": "{{'False' if not value_json.job.estimatedPrintTime else 'True'}}",
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    },
-                ],
-                "val_tpl": "{{value_json.job.estimatedPrintTime}}",
-                "dev_cla": "duration",
-                "unit_of_meas": "s",
-                "device": _config_device,
-            },
+    def _get_discovery_topics(self):
+        if self._is_device_discovery():
+            _compiled = self._compile_device()
+        else:
+            _compiled = self._compile_entities(
+                "sensors", SENSOR_ENTITIES
+            ) + self._compile_entities("controls", CONTROL_ENTITIES)
+        return set(topic for topic, _ in _compiled)
+
+    def _compile_device(self):
+        return self._compile_entities(
+            "device", SENSOR_ENTITIES + CONTROL_ENTITIES, device=True
         )
 
-        ##~~ Configure Print Remaining Time
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_C/config",
-            values={
-                "name": "Approximate completion time",
-                "uniq_id": _node_id + "_PRINTING_C",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "printing"),
-                        "val_tpl": "{{'False' if not value_json.progress.printTimeLeft else 'True'}}",
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    },
-                ],
-                "val_tpl": "{{now() + timedelta(seconds=value_json.progress.printTimeLeft|int(default=0))}}",
-                "dev_cla": "timestamp",
-                "device": _config_device,
-            },
+    def _get_entity_context(self):
+        _profile = self._printer_profile_manager.get_current_or_default()
+        return dict(
+            extruders=_profile["extruder"]["count"],
+            heated_chamber=bool(_profile["heatedChamber"]),
+            psucontrol=bool(self.psucontrol_enabled),
+            snapshot=bool(self.snapshot_enabled),
+            host_metrics=frozenset(self._get_host_metrics()),
+            diagnostic_sensors=self._settings.get_boolean(["diagnostic_sensors"]),
+            split_status=bool(self._status_split),
         )
 
-        ##~~ Configure Print Current Z
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_PRINTING_Z/config",
-            values={
-                "name": "Current Z",
-                "uniq_id": _node_id + "_PRINTING_Z",
-                "stat_t": "~" + self._generate_topic("hassTopic", "printing"),
-                "unit_of_meas": "mm",
-                "val_tpl": "{{value_json.currentZ|float(0)}}",
-                "device": _config_device,
-                "ic": "mdi:axis-z-arrow",
-            },
-        )
+    def _compile_entities(self, name, entities, device=False):
+        # Compiled once, until the topics or any of the entity conditions change
+        _context = self._get_entity_context()
+        _key = tuple(sorted(_context.items()))
+        _cached = self._compiled_entities.get(name)
+        if _cached and _cached[0] == _key:
+            return _cached[1]
 
-        ##~~ Configure Slicing Status
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_SLICING_P/config",
-            values={
-                "name": "Slicing progress",
-                "uniq_id": _node_id + "_SLICING_P",
-                "stat_t": "~" + self._generate_topic("progressTopic", "slicing"),
-                "unit_of_meas": "%",
-                "val_tpl": "{{value_json.progress|float(0)}}",
-                "device": _config_device,
+        _node_id = self._settings.get(["node_id"])
+        _kwargs = dict(
+            discovery_topic=self._settings.get(["discovery_topic"]),
+            node_id=_node_id,
+            common={
+                "~": self._generate_topic("baseTopic", "", full=True),
+                "device": self._generate_device_config(
+                    _node_id,
+                    self._settings.get(["node_name"]),
+                    self._settings.get(["device_manufacturer"]),
+                    self._settings.get(["device_model"]),
+                ),
             },
-        )
-
-        ##~~ Configure Slicing File
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_SLICING_F/config",
-            values={
-                "name": "Slicing file",
-                "uniq_id": _node_id + "_SLICING_F",
-                "stat_t": "~" + self._generate_topic("progressTopic", "slicing"),
-                "val_tpl": "{{value_json.source_path}}",
-                "device": _config_device,
-                "ic": "mdi:file",
+            availability={
+                "t": "~" + self._generate_topic("lwTopic", ""),
+                "pl_avail": "connected",
+                "pl_not_avail": "disconnected",
             },
         )
-
-        ##~~ Tool Temperature
-        _e = self._printer_profile_manager.get_current_or_default()["extruder"]["count"]
-        for x in range(_e):
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_TOOL"
-                + str(x)
-                + "/config",
-                values={
-                    "name": "Tool " + str(x) + " temperature",
-                    "uniq_id": _node_id + "_TOOL" + str(x),
-                    "stat_t": "~"
-                    + self._generate_topic("temperatureTopic", "tool" + str(x)),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.actual|float(0)}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:printer-3d-nozzle",
-                },
+        if self._status_split:
+            _kwargs["split"] = (
+                Topic("hassTopic", "printing"),
+                frozenset(self._status_split),
             )
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_TOOL"
-                + str(x)
-                + "_TARGET"
-                + "/config",
-                values={
-                    "name": "Tool " + str(x) + " target",
-                    "uniq_id": _node_id + "_TOOL" + str(x) + "_TARGET",
-                    "stat_t": "~"
-                    + self._generate_topic("temperatureTopic", "tool" + str(x)),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.target|float(0)}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:printer-3d-nozzle",
-                },
-            )
-
-        ##~~ Bed Temperature
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_BED/config",
-            values={
-                "name": "Bed temperature",
-                "uniq_id": _node_id + "_BED",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "bed"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.actual|float(0)}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
-            },
-        )
-        self._generate_sensor(
-            topic=_discovery_topic + "/sensor/" + _node_id + "_BED_TARGET/config",
-            values={
-                "name": "Bed target",
-                "uniq_id": _node_id + "_BED_TARGET",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "bed"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.target|float(0)}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
-            },
+        _resolve_topic = lambda topic_type, topic: "~" + self._generate_topic(
+            topic_type, topic
         )
-
-        ##~~ Chamber Temperature
-        _h = self._printer_profile_manager.get_current_or_default()["heatedChamber"]
-        if _h:
-            self._generate_sensor(
-                topic=_discovery_topic + "/sensor/" + _node_id + "_CHAMBER/config",
-                values={
-                    "name": "Chamber temperature",
-                    "uniq_id": _node_id + "_CHAMBER",
-                    "stat_t": "~" + self._generate_topic("temperatureTopic", "chamber"),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.actual|float(0)}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:radiator",
-                },
-            )
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/sensor/"
-                + _node_id
-                + "_CHAMBER_TARGET/config",
-                values={
-                    "name": "Chamber target",
-                    "uniq_id": _node_id + "_CHAMBER_TARGET",
-                    "stat_t": "~" + self._generate_topic("temperatureTopic", "chamber"),
-                    "unit_of_meas": "°C",
-                    "val_tpl": "{{value_json.target|float(0)}}",
-                    "device": _config_device,
-                    "dev_cla": "temperature",
-                    "ic": "mdi:radiator",
+        if device:
+            _compiled = compile_device(
+                entities,
+                _context,
+                _resolve_topic,
+                origin={
+                    "name": "OctoPrint-HomeAssistant",
+                    "sw": self._plugin_version,
+                    "url": "https://github.com/cmroche/OctoPrint-HomeAssistant",
                 },
+                **_kwargs
             )
-
-        ##~~ SoC Temperature (if supported)
-        self._generate_sensor(
-            topic="homeassistant/sensor/" + _node_id + "_SOC/config",
-            values={
-                "name": "SoC temperature",
-                "uniq_id": _node_id + "_SOC",
-                "stat_t": "~" + self._generate_topic("temperatureTopic", "soc"),
-                "unit_of_meas": "°C",
-                "val_tpl": "{{value_json.temperature|float(0)|round(1)}}",
-                "device": _config_device,
-                "dev_cla": "temperature",
-                "ic": "mdi:radiator",
-            },
+        else:
+            _compiled = compile_entities(entities, _context, _resolve_topic, **_kwargs)
+        self._compiled_entities[name] = (_key, _compiled)
+        return _compiled
+
+    def _publish_entities(self, compiled, force=False):
+        # Skip configs that are identical to the last one published on their topic
+        _changed = [
+            (topic, payload)
+            for topic, payload in compiled
+            if force or self._discovery_cache.get(topic) != payload
+        ]
+        if not _changed:
+            return
+
+        self._publish_many(PUBLISH_DISCOVERY, _changed)
+        for topic, payload in _changed:
+            self._discovery_cache[topic] = payload
+
+    def _clear_discovery(self, topics):
+        # An empty retained config removes the entities from Home Assistant
+        if not topics:
+            return
+
+        self._logger.info("Removing %d stale discovery configs", len(topics))
+        self._publish_many(
+            PUBLISH_DISCOVERY,
+            [(topic, "") for topic in sorted(topics)],
+            retained=True,
         )
-
-    def _generate_sensor(self, topic, values):
-        payload={}
-        payload.update({
-            "avty": [],
-            "~": self._generate_topic("baseTopic", "", full=True),
-        })
-
-        # Add in set values
-        payload.update(values)
-
-        # Append default availability topic
-        payload["avty"].append({
-            "t": "~" + self._generate_topic("lwTopic", ""),
-            "pl_avail": "connected",
-            "pl_not_avail": "disconnected",
-        })
-
-        self.mqtt_publish(topic, payload, allow_queueing=True)
+        for topic in topics:
+            self._discovery_cache.pop(topic, None)
 
     def _generate_device_config(
         self, _node_id, _node_name, _device_manufacturer, _device_model
@@ -621,32 +856,338 @@ class HomeassistantPlugin(
         }
         return _config_device
 
+    def _resolve_host_sensors(self):
+        # Probing every hwmon and thermal zone is expensive, only do it once and
+        # read the matching file directly afterwards.
+        self._cpu_temp_path = None
+        _candidates = {}
+        for pattern, name_file, value_file in (
+            ("/sys/class/hwmon/hwmon*", "name", "temp1_input"),
+            ("/sys/class/thermal/thermal_zone*", "type", "temp"),
+        ):
+            for path in sorted(glob.glob(pattern)):
+                try:
+                    with open(os.path.join(path, name_file)) as f:
+                        _name = f.read().strip()
+                except (IOError, OSError):
+                    continue
+                _value_path = os.path.join(path, value_file)
+                if _name in CPU_TEMP_SENSORS and os.path.exists(_value_path):
+                    _candidates.setdefault(_name, _value_path)
+
+        for name in CPU_TEMP_SENSORS:
+            if name in _candidates:
+                self._cpu_temp_path = _candidates[name]
+                self._logger.info("Using SoC temperature sensor %s", self._cpu_temp_path)
+                break
+
+        # Fall back to psutil, which knows about more platforms, but remember
+        # which of its sensors to read so it isn't searched on every tick
+        self._cpu_temp_sensor = None
+        if not self._cpu_temp_path and hasattr(psutil, "sensors_temperatures"):
+            temps = psutil.sensors_temperatures() or {}
+            for name in CPU_TEMP_SENSORS:
+                if temps.get(name):
+                    self._cpu_temp_sensor = name
+                    self._logger.info("Using psutil SoC temperature sensor %s", name)
+                    break
+        if not self._cpu_temp_path and not self._cpu_temp_sensor:
+            self._logger.info("No SoC temperature sensor found")
+
+        self._throttled_source = None
+        if os.path.exists(RPI_THROTTLED_PATH):
+            self._throttled_source = RPI_THROTTLED_PATH
+        else:
+            import shutil
+
+            if shutil.which("vcgencmd"):
+                self._throttled_source = "vcgencmd"
+
+        # The first call only sets the reference point for the next ones
+        psutil.cpu_percent(interval=None)
+
     def _get_cpu_temp(self):
-        if hasattr(psutil, "sensors_temperatures"):
-            temps = psutil.sensors_temperatures()
+        if self._cpu_temp_path:
+            try:
+                with open(self._cpu_temp_path) as f:
+                    return int(f.read().strip()) / 1000.0
+            except (IOError, OSError, ValueError):
+                self._logger.debug("Unable to read %s", self._cpu_temp_path)
+                return None
+
+        if self._cpu_temp_sensor:
+            temps = psutil.sensors_temperatures().get(self._cpu_temp_sensor)
             if temps:
-                if "coretemp" in temps:
-                    return temps["coretemp"][0].current
-                if "cpu-thermal" in temps:
-                    return temps["cpu-thermal"][0].current
-                if "cpu_thermal" in temps:
-                    return temps["cpu_thermal"][0].current
+                return temps[0].current
         return None
 
+    def _get_throttled(self):
+        if self._throttled_source == RPI_THROTTLED_PATH:
+            with open(RPI_THROTTLED_PATH) as f:
+                _value = int(f.read().strip(), 16)
+        elif self._throttled_source == "vcgencmd":
+            import subprocess
+
+            _output = subprocess.check_output(["vcgencmd", "get_throttled"], timeout=5)
+            _value = int(_output.decode().strip().split("=")[1], 16)
+        else:
+            return None
+
+        data = dict((k, bool(_value & v)) for k, v in THROTTLED_FLAGS.items())
+        data["value"] = hex(_value)
+        data["problem"] = bool(_value & 0xF)
+        return data
+
+    def _get_host_metrics(self):
+        _intervals = self._settings.get(["host_metrics"]) or {}
+        _metrics = dict((k, v) for k, v in _intervals.items() if v)
+        if not self._throttled_source:
+            _metrics.pop("throttled", None)
+        if not self._cpu_temp_path and not self._cpu_temp_sensor:
+            _metrics.pop("soc_temperature", None)
+        return _metrics
+
+    def _sample_host_metric(self, name):
+        if name == "soc_temperature":
+            return {"temperature": self._get_cpu_temp()}
+        if name == "cpu_load":
+            return {"value": psutil.cpu_percent(interval=None)}
+        if name == "memory":
+            return {"value": psutil.virtual_memory().percent}
+        if name == "disk_free":
+            _usage = psutil.disk_usage(self._settings.global_get_basefolder("uploads"))
+            return {"value": _usage.free / 1073741824.0}
+        if name == "throttled":
+            return self._get_throttled()
+        return None
+
+    def _is_host_metric_changed(self, name, data):
+        _value = data.get("temperature", data.get("value"))
+        _last = self._host_values.get(name)
+        self._host_values[name] = _value
+
+        if not isinstance(_value, (int, float)) or not isinstance(_last, (int, float)):
+            return _value != _last
+        return abs(_value - _last) > abs(_last) * self._host_change_ratio
+
     def _generate_status(self):
+        _now = time.monotonic()
+        _tick = self._host_cadence.current()
+        _changed = False
+
+        # Each metric has its own interval, sample the ones that are due this tick
+        for name, interval in self._get_host_metrics().items():
+            _last = self._host_sampled.get(name)
+            if _last is not None and _now - _last + _tick / 2.0 < interval:
+                continue
+            self._host_sampled[name] = _now
 
-        data = {"temperature": self._get_cpu_temp()}
+            try:
+                data = self._sample_host_metric(name)
+            except Exception as e:
+                self._logger.error("Unable to sample host metric %s: %s", name, e)
+                continue
+            if data is None:
+                continue
+            if self._is_host_metric_changed(name, data):
+                _changed = True
+
+            if name == "soc_temperature":
+                self._record_history("soc", data["temperature"])
+                _topic = self._generate_topic("temperatureTopic", "soc", full=True)
+            else:
+                _topic = self._generate_topic("hassTopic", "host/" + name, full=True)
 
-        if self.mqtt_publish_with_timestamp:
-            self.mqtt_publish_with_timestamp(
-                self._generate_topic("temperatureTopic", "soc", full=True),
+            self._publish(
+                PUBLISH_TELEMETRY,
+                _topic,
                 data,
-                allow_queueing=True,
+                timestamp=True,
             )
 
-    def _generate_printer_status(self):
+        return _changed
+
+    def _record_history(self, name, value):
+        if not self._history_size or not isinstance(value, (int, float)):
+            return
+        with self._history_lock:
+            _buffer = self._history.get(name)
+            if _buffer is None:
+                _buffer = self._history[name] = RingBuffer(self._history_size)
+        _buffer.append(value)
+
+    def _generate_history(self):
+        # Home Assistant can record these summaries instead of every sample
+        with self._history_lock:
+            _series = list(self._history.items())
+
+        for name, buffer in _series:
+            _summary = buffer.summary(self._history_window)
+            if _summary is None:
+                continue
+            _summary = dict((k, round(v, 2)) for k, v in _summary.items())
+            # A steady value gives the same summary tick after tick
+            if _summary == self._history_published.get(name):
+                continue
+            self._history_published[name] = _summary
+
+            self._publish(
+                PUBLISH_STATE,
+                self._generate_topic("hassTopic", "stats/" + name, full=True),
+                _summary,
+            )
+
+    def _generate_cadence(self):
+        data = {
+            "printer": self._update_cadence.current(),
+            "host": self._host_cadence.current(),
+        }
+        # The printer cadence moves on every tick while printing, this is only a
+        # diagnostic so don't report it more often than the slowest host tick.
+        _now = time.monotonic()
+        if data == self._published_cadence or (
+            _now - self._published_cadence_time < self._host_cadence.ceiling
+        ):
+            return
+        self._published_cadence = data
+        self._published_cadence_time = _now
+
+        self._publish(
+            PUBLISH_STATE,
+            self._generate_topic("hassTopic", "cadence", full=True),
+            data,
+        )
+
+    def _get_diagnostics(self):
+        data = self._metrics.as_dict()
+        if self._publish_worker:
+            data["queue"] = {
+                "pending": self._publish_worker.pending(),
+                "dropped": self._publish_worker.dropped,
+                "offline": self._publish_worker.offline(),
+            }
+        data["status"] = {
+            "triggers": self._status_triggers,
+            "merged": self._status_merged,
+        }
+        data["cadence"] = {
+            "printer": self._update_cadence.current(),
+            "host": self._host_cadence.current(),
+        }
+        if self._command_queue:
+            data["commands"] = self._command_queue.status()
+        return data
+
+    def _generate_diagnostics(self):
+        if not self._settings.get_boolean(["diagnostic_sensors"]):
+            return
+
+        data = self._metrics.totals()
+        data["classes"] = dict(
+            (k, {"messages": v["messages"], "bytes": v["bytes"]})
+            for k, v in self._metrics.as_dict()["publishes"].items()
+        )
+        self._publish(
+            PUBLISH_STATE,
+            self._generate_topic("hassTopic", "diagnostics", full=True),
+            data,
+        )
+
+    def _flatten_status(self, data, prefix="", flat=None):
+        if flat is None:
+            flat = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                self._flatten_status(value, prefix + key + ".", flat)
+            else:
+                flat[prefix + key] = value
+        return flat
+
+    def _is_status_changed(self, flat):
+        if self._status_snapshot is None:
+            return True
+
+        _last = self._status_snapshot
+        if _last.keys() != flat.keys():
+            return True
+
+        for key, value in flat.items():
+            _previous = _last[key]
+            if value == _previous:
+                continue
+
+            # Small changes on thresholded numeric fields are not worth a publish
+            _threshold = self._status_thresholds.get(key)
+            if (
+                _threshold
+                and isinstance(value, (int, float))
+                and isinstance(_previous, (int, float))
+                and abs(value - _previous) < _threshold
+            ):
+                continue
+
+            return True
+
+        return False
+
+    def _schedule_printer_status(self):
+        if not self._status_window:
+            self._generate_printer_status()
+            return
+
+        # Collapse bursts of triggers into a single publish, the timer is pushed
+        # back on every trigger but never past the max latency of the first one.
+        with self._coalesce_lock:
+            self._status_triggers += 1
+            _now = time.monotonic()
+            if self._coalesce_timer is None:
+                self._coalesce_started = _now
+            else:
+                self._status_merged += 1
+                self._coalesce_timer.cancel()
+
+            _delay = min(
+                self._status_window,
+                max(0, self._coalesce_started + self._status_max_latency - _now),
+            )
+            self._coalesce_generation += 1
+            self._coalesce_timer = threading.Timer(
+                _delay, self._flush_printer_status, args=(self._coalesce_generation,)
+            )
+            self._coalesce_timer.daemon = True
+            self._coalesce_timer.start()
+
+    def _flush_printer_status(self, generation):
+        with self._coalesce_lock:
+            if generation != self._coalesce_generation:
+                return
+            self._coalesce_timer = None
+
+        self._logger.debug(
+            "Publishing coalesced printer status, %d of %d triggers merged",
+            self._status_merged,
+            self._status_triggers,
+        )
+        self._generate_printer_status()
+
+    def _generate_printer_status(self, force=False):
+        if not self.mqtt_publish_with_timestamp:
+            return False
 
         data = self._printer.get_current_data()
+        if self._status_projection:
+            data = self._status_projection(data)
+        self._record_history(
+            "progress", (data.get("progress") or {}).get("completion")
+        )
+
+        with self._status_lock:
+            _flat = self._flatten_status(data)
+            if not force and not self._is_status_changed(_flat):
+                self._logger.debug("Printer status unchanged, skipping publish")
+                return False
+            self._status_snapshot = _flat
+
         try:
             data["progress"]["printTimeLeftFormatted"] = str(
                 datetime.timedelta(seconds=int(data["progress"]["printTimeLeft"]))
@@ -666,25 +1207,49 @@ class HomeassistantPlugin(
         except:
             data["job"]["estimatedPrintTimeFormatted"] = None
 
-        if self.mqtt_publish_with_timestamp:
-            self.mqtt_publish_with_timestamp(
-                self._generate_topic("hassTopic", "printing", full=True),
-                data,
-                allow_queueing=True,
+        self._publish(
+            PUBLISH_STATE,
+            self._generate_topic("hassTopic", "printing", full=True),
+            data,
+            timestamp=True,
+        )
+        if self._status_split:
+            self._generate_split_status(data, force)
+        return True
+
+    def _generate_split_status(self, data, force=False):
+        # Only the fields that changed are published, so Home Assistant only
+        # evaluates the templates of the sensors that read them
+        _changed = []
+        with self._status_lock:
+            for field in self._status_split:
+                value = data
+                for key in field.split("."):
+                    value = value.get(key) if isinstance(value, dict) else None
+                _payload = json.dumps(value)
+                if not force and self._status_split_published.get(field) == _payload:
+                    continue
+                self._status_split_published[field] = _payload
+                _changed.append((field, _payload))
+
+        for field, payload in _changed:
+            self._publish(
+                PUBLISH_STATE,
+                self._generate_topic(
+                    "hassTopic", "printing/" + field.replace(".", "/"), full=True
+                ),
+                payload,
             )
 
     def _generate_connection_status(self):
 
         state, _, _, _ = self._printer.get_current_connection()
         state_connected = "Disconnected" if state == "Closed" else "Connected"
-        # Function can be called by on_event before on_after_startup has run.
-        # This will throw a TypeError since self.mqtt_publish is still null.
-        if self.mqtt_publish:
-            self.mqtt_publish(
-                self._generate_topic("hassTopic", "Connected", full=True),
-                state_connected,
-                allow_queueing=True,
-            )
+        self._publish(
+            PUBLISH_STATE,
+            self._generate_topic("hassTopic", "Connected", full=True),
+            state_connected,
+        )
 
     def _generate_psu_state(self, psu_state=None):
         if self.psucontrol_enabled:
@@ -694,384 +1259,484 @@ class HomeassistantPlugin(
                     "No psu_state specified, state retrieved from helper: "
                     + str(psu_state)
                 )
-            self.mqtt_publish(
+            self._publish(
+                PUBLISH_STATE,
                 self._generate_topic("hassTopic", "psu_on", full=True),
                 str(psu_state),
-                allow_queueing=True,
             )
 
+    def _get_subscriptions(self):
+        _subscriptions = {
+            self._generate_topic("lwTopic", "", full=True): self._on_mqtt_message,
+            self._settings.get(["discovery_topic"]) + "/status": self._on_ha_status,
+        }
+        _prefix = self._generate_topic("controlTopic", "", full=True)
+        if _prefix.endswith("/"):
+            _subscriptions[_prefix + "+"] = self._on_control_message
+        else:
+            # The control topic isn't a topic level of its own, so a wildcard
+            # can't match it
+            for control in CONTROL_ROUTES:
+                _subscriptions[_prefix + control] = self._on_control_message
+        return _subscriptions
+
+    def _update_subscriptions(self):
+        # Only subscribes to topics that aren't active yet, and drops the ones
+        # left behind when the base or control topics changed.
+        if not getattr(self, "mqtt_subscribe", None):
+            return
+
+        _wanted = self._get_subscriptions()
+        with self._subscription_lock:
+            for topic, handler in list(self._subscriptions.items()):
+                if _wanted.get(topic) == handler:
+                    continue
+                if self.mqtt_unsubscribe:
+                    self._logger.debug("Unsubscribing from " + topic)
+                    self.mqtt_unsubscribe(handler, topic=topic)
+                del self._subscriptions[topic]
+
+            for topic, handler in _wanted.items():
+                if topic not in self._subscriptions:
+                    self._logger.debug("Subscribing to " + topic)
+                    self.mqtt_subscribe(topic, handler)
+                    self._subscriptions[topic] = handler
+
+    def _on_control_message(
+        self, topic, message, retained=None, qos=None, *args, **kwargs
+    ):
+        _prefix = self._generate_topic("controlTopic", "", full=True)
+        _control = topic[len(_prefix) :] if topic.startswith(_prefix) else None
+        _route = CONTROL_ROUTES.get(_control)
+        if _route is None:
+            self._logger.debug("Ignoring message on unknown control topic " + topic)
+            return
+        if (_control == "psu" and not self.psucontrol_enabled) or (
+            _control == "camera_snapshot" and not self.snapshot_enabled
+        ):
+            self._logger.debug("Ignoring message for disabled control " + _control)
+            return
+
+        _handler, _accepted = _route
+        try:
+            if isinstance(message, bytes):
+                message = message.decode("utf-8")
+            if _accepted == "json":
+                message = json.loads(message)
+        except ValueError as e:
+            self._logger.error(
+                "Invalid payload received on " + topic + ": " + str(e)
+            )
+            return
+        if isinstance(_accepted, tuple) and message not in _accepted:
+            self._logger.error(
+                "Unknown message received on " + topic + ": " + str(message)
+            )
+            return
+
+        getattr(self, _handler)(topic, message, retained=retained, qos=qos)
+
+    @instrumented
     def _on_emergency_stop(
         self, topic, message, retained=None, qos=None, *args, **kwargs
     ):
         # In Home Assistant, MQTT buttons send the message 'PRESS' when pressed.
         self._logger.debug("Emergency stop message received: " + str(message))
-        if message == b"PRESS":
-            self._printer.commands("M112")
-        else:
-            self._logger.error("Unknown message received: " + str(message))
+        if self._command_queue:
+            self._command_queue.clear()
+        self._cancel_jog()
+        self._printer.commands("M112")
 
+    @instrumented
     def _on_cancel_print(
         self, topic, message, retained=None, qos=None, *args, **kwargs
     ):
         self._logger.debug("Cancel print message received: " + str(message))
-        if message == b"PRESS":
-            self._printer.cancel_print()
-        else:
-            self._logger.error("Unknown message received: " + str(message))
+        self._printer.cancel_print()
 
+    @instrumented
     def _on_pause_print(self, topic, message, retained=None, qos=None, *args, **kwargs):
         # In Home Assistant, MQTT switches send the message 'True' when turned on and 'False' when turned off.
         self._logger.debug("Pause print message received: " + str(message))
-        if message == b"True":
+        if message == "True":
             self._printer.pause_print()
-        elif message == b"False":
-            self._printer.resume_print()
         else:
-            self._logger.error("Unknown message received: " + str(message))
+            self._printer.resume_print()
 
+    @instrumented
     def _on_shutdown_system(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Shutdown print message received: " + str(message))
-        if message == b"PRESS":
-            shutdown_command = self._settings.global_get(
-                ["server", "commands", "systemShutdownCommand"]
-            )
-            try:
-                import sarge
+        shutdown_command = self._settings.global_get(
+            ["server", "commands", "systemShutdownCommand"]
+        )
+        try:
+            import sarge
 
-                sarge.run(shutdown_command, async_=True)
-            except Exception as e:
-                self._logger.info("Unable to run shutdown command: " + str(e))
-        else:
-            self._logger.error("Unknown message received: " + str(message))
+            sarge.run(shutdown_command, async_=True)
+        except Exception as e:
+            self._logger.info("Unable to run shutdown command: " + str(e))
 
+    @instrumented
     def _on_restart_system(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Reboot print message received: " + str(message))
-        if message == b"PRESS":
-            _command = self._settings.global_get(
-                ["server", "commands", "systemRestartCommand"]
-            )
-            try:
-                import sarge
+        _command = self._settings.global_get(
+            ["server", "commands", "systemRestartCommand"]
+        )
+        try:
+            import sarge
 
-                sarge.run(_command, async_=True)
-            except Exception as e:
-                self._logger.info("Unable to run system reboot command: " + str(e))
-        else:
-            self._logger.error("Unknown message received: " + str(message))
+            sarge.run(_command, async_=True)
+        except Exception as e:
+            self._logger.info("Unable to run system reboot command: " + str(e))
 
+    @instrumented
     def _on_restart_server(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Restart print message received: " + str(message))
-        if message == b"PRESS":
-            _command = self._settings.global_get(
-                ["server", "commands", "serverRestartCommand"]
-            )
-            try:
-                import sarge
+        _command = self._settings.global_get(
+            ["server", "commands", "serverRestartCommand"]
+        )
+        try:
+            import sarge
 
-                sarge.run(_command, async_=True)
-            except Exception as e:
-                self._logger.info("Unable to run system reboot command: " + str(e))
-        else:
-            self._logger.error("Unknown message received: " + str(message))
+            sarge.run(_command, async_=True)
+        except Exception as e:
+            self._logger.info("Unable to run system reboot command: " + str(e))
 
+    @instrumented
     def _on_psu(self, topic, message, retained=None, qos=None, *args, **kwargs):
-        message = message.decode()
         self._logger.debug("PSUControl message received: " + message)
         if message == "True":
             self._logger.info("Turning on PSU")
             self.turn_psu_on()
-        elif message == "False":
+        else:
             self._logger.info("Turning off PSU")
             self.turn_psu_off()
-        else:
-            self._logger.error("Unknown message received: " + str(message))
 
+    @instrumented
     def _on_camera(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Camera snapshot message received: " + str(message))
-        if self.snapshot_enabled and message == b"PRESS":
-            import urllib.request as urlreq
+        # The snapshot entity is a switch, turning it on takes a snapshot
+        if message in ("PRESS", "True"):
+            self._request_snapshot()
+
+    def _request_snapshot(self, path=None):
+        # Only the newest of the requests received while an image is being
+        # processed is kept, it is processed right after.
+        with self._snapshot_lock:
+            if self._snapshot_busy:
+                self._logger.debug("Snapshot already in progress, queueing request")
+                self._snapshot_pending = (path,)
+                return
+            self._snapshot_busy = True
+
+        _thread = threading.Thread(
+            target=self._publish_snapshot, args=(path,), name="homeassistant-snapshot"
+        )
+        _thread.daemon = True
+        _thread.start()
 
-            url_handle = urlreq.urlopen(self.snapshot_path)
-            file_content = url_handle.read()
-            url_handle.close()
-            self.mqtt_publish(
+    def _publish_snapshot(self, path=None):
+        while True:
+            try:
+                self._publish_camera_image(path)
+            except Exception as e:
+                self._logger.error("Unable to publish camera snapshot: " + str(e))
+
+            with self._snapshot_lock:
+                if self._snapshot_pending is None:
+                    self._snapshot_busy = False
+                    return
+                (path,) = self._snapshot_pending
+                self._snapshot_pending = None
+
+    def _publish_camera_image(self, path=None):
+        source = path if path else self._fetch_snapshot()
+        image, thumbnail = self._prepare_camera_image(source)
+
+        if image is not None:
+            self._publish(
+                PUBLISH_STATE,
                 self._generate_topic("baseTopic", "camera", full=True),
-                file_content,
-                allow_queueing=False,
+                image,
+                raw_data=True,
+            )
+        if thumbnail is not None:
+            self._publish(
+                PUBLISH_STATE,
+                self._generate_topic("baseTopic", "camera/thumbnail", full=True),
+                thumbnail,
                 raw_data=True,
             )
-        elif self.snapshot_enabled and not message == "PRESS":
-            self._logger.error("Unknown message received: " + str(message))
 
+    def _prepare_camera_image(self, source):
+        # The source is either the raw snapshot, or the path of a timelapse capture
+        _max_bytes = self._settings.get_int(["camera_max_bytes"])
+        if isinstance(source, bytes):
+            _size = len(source)
+            _fp = io.BytesIO(source)
+        else:
+            _size = os.path.getsize(source)
+            _fp = source
+
+        try:
+            from PIL import Image
+        except ImportError:
+            # Pillow is a requirement, but a manual install may lack it. Images
+            # can't be downscaled then, only capped in size.
+            if _max_bytes and _size > _max_bytes:
+                self._logger.warning(
+                    "Camera image is %d bytes, over the %d bytes limit", _size, _max_bytes
+                )
+                return None, None
+            return self._read_camera_image(source), None
+
+        _max_width = self._settings.get_int(["camera_max_width"])
+        _max_height = self._settings.get_int(["camera_max_height"])
+        _quality = self._settings.get_int(["camera_jpeg_quality"])
+        _thumbnail_size = self._settings.get_int(["camera_thumbnail_size"])
+
+        with Image.open(_fp) as image:
+            _width, _height = image.size
+            if (
+                image.format == "JPEG"
+                and (not _max_width or _width <= _max_width)
+                and (not _max_height or _height <= _max_height)
+                and (not _max_bytes or _size <= _max_bytes)
+            ):
+                content = self._read_camera_image(source)
+            else:
+                # thumbnail() keeps the aspect ratio and lets the JPEG decoder downscale
+                image.thumbnail((_max_width or _width, _max_height or _height))
+                content = self._encode_camera_image(image, _quality, _max_bytes)
+                if content is None:
+                    self._logger.warning(
+                        "Unable to fit camera image in %d bytes, dropping it", _max_bytes
+                    )
+
+            thumbnail = None
+            if _thumbnail_size:
+                image.thumbnail((_thumbnail_size, _thumbnail_size))
+                thumbnail = self._encode_camera_image(image, _quality, 0)
+
+        return content, thumbnail
+
+    def _read_camera_image(self, source):
+        if isinstance(source, bytes):
+            return source
+        with open(source, "rb") as file_handle:
+            return file_handle.read()
+
+    def _encode_camera_image(self, image, quality, max_bytes):
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        # Lower the quality step by step until the image fits in the byte cap
+        while True:
+            _buffer = io.BytesIO()
+            image.save(_buffer, format="JPEG", quality=quality, optimize=True)
+            content = _buffer.getvalue()
+            if not max_bytes or len(content) <= max_bytes:
+                return content
+            if quality <= 30:
+                return None
+            quality = max(30, quality - 10)
+
+    def _fetch_snapshot(self):
+        import http.client as http_client
+        from urllib.parse import urlparse
+
+        _timeout = self._settings.get_float(["snapshot_timeout"])
+        _url = urlparse(self.snapshot_path)
+
+        if _url.scheme not in ("http", "https"):
+            import urllib.request as urlreq
+
+            url_handle = urlreq.urlopen(self.snapshot_path, timeout=_timeout)
+            try:
+                return url_handle.read()
+            finally:
+                url_handle.close()
+
+        _path = _url.path or "/"
+        if _url.query:
+            _path += "?" + _url.query
+
+        # Keep the connection alive between snapshots, but reconnect once if the
+        # streamer closed it in the meantime.
+        for attempt in range(2):
+            _conn = self._get_snapshot_connection(_url, _timeout)
+            try:
+                _conn.request("GET", _path)
+                _response = _conn.getresponse()
+                file_content = _response.read()
+            except (http_client.HTTPException, socket.error):
+                self._close_snapshot_connection()
+                if attempt:
+                    raise
+                continue
+
+            if _response.status != 200:
+                raise IOError(
+                    "Snapshot request returned HTTP status %d" % _response.status
+                )
+            return file_content
+
+    def _get_snapshot_connection(self, url, timeout):
+        import http.client as http_client
+
+        if self._snapshot_conn is None:
+            _cls = (
+                http_client.HTTPSConnection
+                if url.scheme == "https"
+                else http_client.HTTPConnection
+            )
+            self._snapshot_conn = _cls(url.hostname, url.port, timeout=timeout)
+        return self._snapshot_conn
+
+    def _close_snapshot_connection(self):
+        if self._snapshot_conn is not None:
+            self._snapshot_conn.close()
+            self._snapshot_conn = None
+
+    @instrumented
     def _on_connect_printer(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("(Dis)Connecting to printer" + str(message))
         try:
-          if message == b'True':
+          if message == "True":
             self._printer.connect()
-          elif message == b'False':
-            self._printer.disconnect()
           else:
-            self._logger.error("Unknown message received: " + str(message))
+            self._printer.disconnect()
         except Exception as e:
           self._logger.error("Unable to run connect command: " + str(e))
 
+    @instrumented
     def _on_home(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Homing printer: " + str(message))
         if message:
             try:
-                home_payload = json.loads(message)
-                axes = set(home_payload) & set(["x", "y", "z", "e"])
+                axes = set(message) & set(["x", "y", "z", "e"])
                 self._printer.home(list(axes))
             except Exception as e:
                 self._logger.error("Unable to run home command: " + str(e))
 
+    @instrumented
     def _on_jog(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Jogging printer: " + str(message))
-        if message:
-            try:
-                jog_payload = json.loads(message)
-                axes_keys = set(jog_payload.keys()) & set(["x", "y", "z"])
-                axes = {k: v for (k, v) in jog_payload.items() if k in axes_keys}
-                self._printer.jog(axes, jog_payload.get("speed"))
-            except Exception as e:
-                self._logger.error("Unable to run jog command: " + str(e))
+        if not message:
+            return
+        try:
+            _axes = dict(
+                (k, float(v)) for k, v in message.items() if k in ("x", "y", "z")
+            )
+        except (AttributeError, TypeError, ValueError) as e:
+            self._logger.error("Unable to run jog command: " + str(e))
+            return
+        _speed = message.get("speed")
+
+        if not self._jog_window:
+            self._send_jog(_axes, _speed)
+            return
+
+        # Jogs received within the window are summed per axis into a single
+        # relative move, sent when the window of the first one closes.
+        _flush = None
+        with self._jog_lock:
+            if self._jog_timer is not None and _speed != self._jog_speed:
+                # Moves at another speed can't be merged, send the pending one
+                self._jog_timer.cancel()
+                self._jog_timer = None
+                _flush = (self._jog_pending, self._jog_speed)
+                self._jog_pending = {}
+
+            for axis, distance in _axes.items():
+                self._jog_pending[axis] = self._jog_pending.get(axis, 0) + distance
+            self._jog_speed = _speed
+
+            if self._jog_timer is None:
+                self._jog_generation += 1
+                self._jog_timer = threading.Timer(
+                    self._jog_window, self._flush_jog, args=(self._jog_generation,)
+                )
+                self._jog_timer.daemon = True
+                self._jog_timer.start()
+
+        if _flush:
+            self._send_jog(*_flush)
+
+    def _flush_jog(self, generation):
+        with self._jog_lock:
+            if generation != self._jog_generation:
+                return
+            _axes, _speed = self._jog_pending, self._jog_speed
+            self._jog_pending = {}
+            self._jog_timer = None
+        self._send_jog(_axes, _speed)
+
+    def _cancel_jog(self):
+        with self._jog_lock:
+            if self._jog_timer is not None:
+                self._jog_timer.cancel()
+                self._jog_timer = None
+            self._jog_generation += 1
+            self._jog_pending = {}
+
+    def _send_jog(self, axes, speed):
+        _cap = self._jog_max_distance
+        if _cap:
+            axes = dict((k, max(-_cap, min(_cap, v))) for k, v in axes.items())
+        axes = dict((k, v) for k, v in axes.items() if abs(v) > 1e-6)
+        if not axes:
+            return
+        try:
+            self._printer.jog(axes, relative=True, speed=speed)
+        except Exception as e:
+            self._logger.error("Unable to run jog command: " + str(e))
 
+    @instrumented
     def _on_command(self, topic, message, retained=None, qos=None, *args, **kwargs):
         self._logger.debug("Received gcode commands %s", message)
         try:
-            try:
-                self._printer.commands(json.loads(message))
-            except ValueError:
-                self._printer.commands(message)
-        except Exception as e:
-            self._logger.error("Unable to run printer commands: " + str(e))
-
-    def _generate_device_controls(self, subscribe=False):
-
-        _discovery_topic = self._settings.get(["discovery_topic"])
-
-        _node_name = self._settings.get(["node_name"])
-        _node_id = self._settings.get(["node_id"])
-
-        _device_manufacturer = self._settings.get(["device_manufacturer"])
-        _device_model = self._settings.get(["device_model"])
-
-        _config_device = self._generate_device_config(
-            _node_id, _node_name, _device_manufacturer, _device_model
-        )
-
-        # Connect printer
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "connect", full=True),
-                self._on_connect_printer,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_CONNECT/config",
-            values={
-                "name": "Connect to printer",
-                "uniq_id": _node_id + "_CONNECT",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "connect"),
-                "stat_t": self._generate_topic("hassTopic", "Connected", full=True),
-                "pl_off": "False",
-                "pl_on": "True",
-                "stat_on": "Connected",
-                "stat_off": "Disconnected",
-                "device": _config_device,
-                "ic": "mdi:lan-connect",
-            },
-        )
-
-        # Emergency stop
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "stop", full=True),
-                self._on_emergency_stop,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/button/" + _node_id + "_STOP/config",
-            values={
-                "name": "Emergency stop",
-                "uniq_id": _node_id + "_STOP",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "stop"),
-                "device": _config_device,
-                "ic": "mdi:alert-octagon",
-            },
-        )
-
-        # Cancel print
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "cancel", full=True),
-                self._on_cancel_print,
+            _lines = parse_commands(message)
+        except ValueError as e:
+            self._logger.error("Unable to parse printer commands: " + str(e))
+            return
+        if not _lines:
+            return
+        # Streamed to the printer from the command queue's thread
+        if not self._command_queue.submit(_lines):
+            self._logger.error(
+                "Command queue full, dropped %d printer commands", len(_lines)
             )
 
-        self._generate_sensor(
-            topic=_discovery_topic + "/button/" + _node_id + "_CANCEL/config",
-            values={
-                "name": "Cancel print",
-                "uniq_id": _node_id + "_CANCEL",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "cancel"),
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "is_printing"),
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    },
-                ],
-                "device": _config_device,
-                "ic": "mdi:cancel",
-            },
+    def _generate_command_status(self, status):
+        # Acknowledges queued and sent commands, ahead of any other message
+        self._publish(
+            PUBLISH_COMMAND,
+            self._generate_topic("hassTopic", "commands", full=True),
+            status,
         )
 
-        # Pause / resume print
+    def _generate_device_controls(self, subscribe=False, force=False):
+        # All control topics, including the jog, home and commands topics that
+        # don't have a suitable entity, are handled by a single subscription.
         if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "pause", full=True),
-                self._on_pause_print,
-            )
+            self._update_subscriptions()
 
-        self._generate_sensor(
-            topic=_discovery_topic + "/switch/" + _node_id + "_PAUSE/config",
-            values={
-                "name": "Pause print",
-                "uniq_id": _node_id + "_PAUSE",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "pause"),
-                "stat_t": "~" + self._generate_topic("hassTopic", "is_paused"),
-                "avty": [
-                    {
-                        "t": "~" + self._generate_topic("hassTopic", "is_printing"),
-                        "pl_avail": "True",
-                        "pl_not_avail": "False",
-                    },
-                ],
-                "pl_off": "False",
-                "pl_on": "True",
-                "device": _config_device,
-                "ic": "mdi:pause",
-            },
-        )
-
-        # Shutdown, Reboot and Restart OctoPrint
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "shutdown", full=True),
-                self._on_shutdown_system,
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "reboot", full=True),
-                self._on_restart_system,
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "restart", full=True),
-                self._on_restart_server,
-            )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/button/" + _node_id + "_SHUTDOWN/config",
-            values={
-                "name": "Shutdown system",
-                "uniq_id": _node_id + "_SHUTDOWN",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "shutdown"),
-                "device": _config_device,
-                "ic": "mdi:power",
-            },
-        )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/button/" + _node_id + "_REBOOT/config",
-            values={
-                "name": "Reboot system",
-                "uniq_id": _node_id + "_REBOOT",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "reboot"),
-                "device": _config_device,
-                "ic": "mdi:restart-alert",
-            },
-        )
-
-        self._generate_sensor(
-            topic=_discovery_topic + "/button/" + _node_id + "_RESTART/config",
-            values={
-                "name": "Restart server",
-                "uniq_id": _node_id + "_RESTART",
-                "cmd_t": "~" + self._generate_topic("controlTopic", "restart"),
-                "device": _config_device,
-                "ic": "mdi:restart",
-            },
-        )
-
-        # PSUControl
-        if self.psucontrol_enabled:
-            if subscribe:
-                self.mqtt_subscribe(
-                    self._generate_topic("controlTopic", "psu", full=True),
-                    self._on_psu,
-                )
-
-            self._generate_sensor(
-                topic=_discovery_topic + "/switch/" + _node_id + "_PSU/config",
-                values={
-                    "name": "PSU",
-                    "uniq_id": _node_id + "_PSU",
-                    "cmd_t": "~" + self._generate_topic("controlTopic", "psu"),
-                    "stat_t": "~" + self._generate_topic("hassTopic", "psu_on"),
-                    "pl_on": "True",
-                    "pl_off": "False",
-                    "device": _config_device,
-                    "ic": "mdi:flash",
-                },
-            )
-
-        # Camera output
-        if self.snapshot_enabled:
-            if subscribe:
-                self.mqtt_subscribe(
-                    self._generate_topic("controlTopic", "camera_snapshot", full=True),
-                    self._on_camera,
-                )
-
-            self._generate_sensor(
-                topic=_discovery_topic
-                + "/switch/"
-                + _node_id
-                + "_CAMERA_SNAPSHOT/config",
-                values={
-                    "name": "Camera snapshot",
-                    "uniq_id": _node_id + "_CAMERA_SNAPSHOT",
-                    "cmd_t": "~"
-                    + self._generate_topic("controlTopic", "camera_snapshot"),
-                    "stat_t": "~"
-                    + self._generate_topic("controlTopic", "camera_snapshot"),
-                    "pl_off": "False",
-                    "pl_on": "True",
-                    "val_tpl": "{{False}}",
-                    "device": _config_device,
-                    "ic": "mdi:camera-iris",
-                },
-            )
-
-        # Command topics that don't have a suitable sensor configuration. These can be used
-        # through the MQTT.publish service call though.
-        if subscribe:
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "jog", full=True), self._on_jog
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "connect", full=True), self._on_connect_printer
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "home", full=True), self._on_home
-            )
-            self.mqtt_subscribe(
-                self._generate_topic("controlTopic", "commands", full=True),
-                self._on_command,
+        if not self._is_device_discovery():
+            self._publish_entities(
+                self._compile_entities("controls", CONTROL_ENTITIES), force=force
             )
 
     ##~~ EventHandlerPlugin API
 
+    @instrumented
     def on_event(self, event, payload):
+        # MQTT plugin settings may have changed, resolve the topics again
+        if event == Events.SETTINGS_UPDATED:
+            # The MQTT plugin's base topic may have changed
+            self._invalidate_topic_table()
+            self._update_subscriptions()
+
         events = dict(
             comm=(
                 Events.CONNECTING,
@@ -1108,28 +1773,31 @@ class HomeassistantPlugin(
             or event in events["status"]
         ):
             self._logger.debug("Received event " + event + ", updating status")
-            self._generate_printer_status()
+            self._schedule_printer_status()
 
         if event == Events.PRINT_STARTED:
             if self.update_timer:
-                self.mqtt_publish(
+                self._publish(
+                    PUBLISH_STATE,
                     self._generate_topic("hassTopic", "is_printing", full=True),
                     "True",
-                    allow_queueing=True,
                 )
 
+                self._update_cadence.reset()
                 try:
                     self.update_timer.start()
                 except RuntimeError:
-                    # May already be running, it's ok
-                    pass
+                    # Either already running, or cancelled after a previous print
+                    if not self.update_timer.is_alive():
+                        self.update_timer = self._create_update_timer()
+                        self.update_timer.start()
 
         elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
             if self.update_timer:
-                self.mqtt_publish(
+                self._publish(
+                    PUBLISH_STATE,
                     self._generate_topic("hassTopic", "is_printing", full=True),
                     "False",
-                    allow_queueing=True,
                 )
 
                 try:
@@ -1139,17 +1807,17 @@ class HomeassistantPlugin(
                     pass
 
         if event == Events.PRINT_PAUSED:
-            self.mqtt_publish(
+            self._publish(
+                PUBLISH_STATE,
                 self._generate_topic("hassTopic", "is_paused", full=True),
                 "True",
-                allow_queueing=True,
             )
 
         elif event in (Events.PRINT_RESUMED, Events.PRINT_STARTED):
-            self.mqtt_publish(
+            self._publish(
+                PUBLISH_STATE,
                 self._generate_topic("hassTopic", "is_paused", full=True),
                 "False",
-                allow_queueing=True,
             )
 
 
@@ -1160,20 +1828,61 @@ class HomeassistantPlugin(
             self._generate_psu_state(payload["isPSUOn"])
 
         if event == Events.CAPTURE_DONE:
-            file_handle = open(payload["file"], "rb")
-            file_content = file_handle.read()
-            file_handle.close()
-            self.mqtt_publish(
-                self._generate_topic("baseTopic", "camera", full=True),
-                file_content,
-                allow_queueing=False,
-                raw_data=True,
-            )
+            self._request_snapshot(payload["file"])
+
+    ##~~ Temperatures received hook
+
+    def on_temperatures_received(self, comm_instance, parsed_temperatures, *args, **kwargs):
+        try:
+            for heater, (actual, target) in parsed_temperatures.items():
+                self._generate_temperature(heater, actual, target)
+        except Exception as e:
+            self._logger.error("Unable to publish temperatures: " + str(e))
+        return parsed_temperatures
+
+    def _generate_temperature(self, heater, actual, target):
+        if heater.startswith("T") and heater[1:].isdigit():
+            _name = "tool" + heater[1:]
+        elif heater == "B":
+            _name = "bed"
+        elif heater == "C":
+            _name = "chamber"
+        else:
+            _name = heater.lower()
+        if actual is not None:
+            self._record_history(_name, actual)
+
+        # Only publish when the target changed, the actual temperature moved more
+        # than the deadband (at most once per min interval), or for the heartbeat.
+        _now = time.monotonic()
+        _last = self._temperatures.get(_name)
+        if _last is not None:
+            _last_actual, _last_target, _last_time = _last
+            _elapsed = _now - _last_time
+            if (
+                target == _last_target
+                and _elapsed < self._temperature_heartbeat
+                and (
+                    _elapsed < self._temperature_min_interval
+                    or actual is None
+                    or _last_actual is None
+                    or abs(actual - _last_actual) < self._temperature_deadband
+                )
+            ):
+                return
+
+        self._temperatures[_name] = (actual, target, _now)
+        self._publish(
+            PUBLISH_TELEMETRY,
+            self._generate_topic("hassTopic", "temperature/" + _name, full=True),
+            {"actual": actual, "target": target},
+            timestamp=True,
+        )
 
     ##~~ ProgressPlugin API
 
     def on_print_progress(self, storage, path, progress):
-        self._generate_printer_status()
+        self._schedule_printer_status()
 
     def on_slicing_progress(
         self,
@@ -1186,6 +1895,21 @@ class HomeassistantPlugin(
     ):
         pass
 
+    ##~~ SimpleApiPlugin mixin
+
+    def is_api_protected(self):
+        return True
+
+    def on_api_get(self, request):
+        import flask
+        from octoprint.access.permissions import Permissions
+
+        # The metrics describe the setup, only show them to who can read settings
+        if not Permissions.SETTINGS_READ.can():
+            flask.abort(403)
+
+        return flask.jsonify(self._get_diagnostics())
+
     ##~~ WizardPlugin mixin
 
     def is_wizard_required(self):
@@ -1224,7 +1948,7 @@ class HomeassistantPlugin(
 
 
 __plugin_name__ = "HomeAssistant Discovery"
-__plugin_pythoncompat__ = ">=2.7,<4"  # python 2 and 3
+__plugin_pythoncompat__ = ">=3,<4"  # python 3 only
 
 
 def __plugin_load__():
@@ -1233,5 +1957,6 @@ def __plugin_load__():
 
     global __plugin_hooks__
     __plugin_hooks__ = {
-        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.on_temperatures_received,
     }
@@ -0,0 +1,164 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import threading
+import time
+
+
+def parse_commands(payload):
+    """Turns a command payload into a list of G-code lines.
+
+    Accepts a JSON list or string, or plain text with one command per line.
+    Comments and blank lines are dropped.
+    """
+    try:
+        _parsed = json.loads(payload)
+    except ValueError:
+        _parsed = payload
+    if not isinstance(_parsed, list):
+        _parsed = [_parsed]
+
+    _lines = []
+    for entry in _parsed:
+        if not isinstance(entry, str):
+            raise ValueError("Unsupported command " + repr(entry))
+        for line in entry.splitlines():
+            line = line.split(";", 1)[0].strip()
+            if line:
+                _lines.append(line)
+    return _lines
+
+
+class CommandQueue(object):
+    """Streams G-code to the printer in chunks, behind a rate limit.
+
+    submit() only queues the lines, a dedicated thread sends at most
+    chunk_size lines at a time and no more than rate lines per second, so
+    large macros neither block the MQTT thread nor flood the serial buffer.
+    The report callback receives the queue status when a job is queued,
+    at most every report_interval seconds while sending and when it drains.
+    """
+
+    def __init__(
+        self,
+        send,
+        report=None,
+        chunk_size=10,
+        rate=20.0,
+        max_size=1000,
+        report_interval=1.0,
+        logger=None,
+    ):
+        self._send = send
+        self._report = report
+        self._logger = logger or logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        self._lines = collections.deque()
+        self._thread = None
+        self._running = False
+        self.chunk_size = chunk_size
+        self.rate = rate
+        self.max_size = max_size
+        self.report_interval = report_interval
+        self._reported = 0
+        self.jobs = 0
+        self.sent = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def configure(self, chunk_size, rate, max_size):
+        with self._cond:
+            self.chunk_size = max(1, chunk_size)
+            self.rate = rate
+            self.max_size = max_size
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._run, name="homeassistant-commands"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, lines):
+        with self._cond:
+            if len(self._lines) + len(lines) > self.max_size:
+                self.rejected += len(lines)
+                return False
+            self._lines.extend(lines)
+            self.jobs += 1
+            self._cond.notify()
+        self._publish_status()
+        return True
+
+    def clear(self):
+        with self._cond:
+            _dropped = len(self._lines)
+            self._lines.clear()
+        if _dropped:
+            self._publish_status()
+        return _dropped
+
+    def status(self):
+        with self._cond:
+            return {
+                "queued": len(self._lines),
+                "state": "sending" if self._lines else "idle",
+                "jobs": self.jobs,
+                "sent": self.sent,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
+
+    def _publish_status(self):
+        self._reported = time.monotonic()
+        if self._report:
+            self._report(self.status())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._lines and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _chunk = [
+                    self._lines.popleft()
+                    for _ in range(min(self.chunk_size, len(self._lines)))
+                ]
+                _delay = len(_chunk) / float(self.rate) if self.rate > 0 else 0
+                _drained = not self._lines
+
+            _start = time.monotonic()
+            try:
+                self._send(_chunk)
+                self.sent += len(_chunk)
+            except Exception:
+                self.failed += len(_chunk)
+                self._logger.exception("Unable to send commands to the printer")
+            if _drained or _start - self._reported >= self.report_interval:
+                self._publish_status()
+
+            # Wait out the rest of the chunk's time slot. Only stop() cuts it
+            # short, the notify of a submit() just goes back to waiting.
+            _deadline = _start + _delay
+            with self._cond:
+                while self._running:
+                    _remaining = _deadline - time.monotonic()
+                    if _remaining <= 0:
+                        break
+                    self._cond.wait(_remaining)
@@ -0,0 +1,672 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import json
+import re
+
+# Reference to a topic of the MQTT plugin, resolved relative to the base topic
+Topic = collections.namedtuple("Topic", ["topic_type", "topic"])
+
+
+class Entity(object):
+    """Declaration of a Home Assistant entity announced through MQTT discovery.
+
+    config holds the discovery values of the entity, Topic references are
+    resolved and "{index}" expanded when the registry is compiled. when is
+    called with the compile context and skips the entity when it returns
+    False, repeat returns how many indexed copies of it to announce.
+    """
+
+    __slots__ = ("component", "object_id", "config", "when", "repeat")
+
+    def __init__(self, component, object_id, config, when=None, repeat=None):
+        self.component = component
+        self.object_id = object_id
+        self.config = config
+        self.when = when
+        self.repeat = repeat
+
+
+def _is_available(field):
+    return {
+        "t": Topic("hassTopic", "printing"),
+        "val_tpl": "{{'False' if not value_json.%s else 'True'}}" % field,
+        "pl_avail": "True",
+        "pl_not_avail": "False",
+    }
+
+
+_WHILE_PRINTING = {
+    "t": Topic("hassTopic", "is_printing"),
+    "pl_avail": "True",
+    "pl_not_avail": "False",
+}
+
+
+def _temperature(object_id, name, topic, field, icon, **kwargs):
+    _config = {
+        "name": name,
+        "stat_t": Topic("hassTopic", "temperature/" + topic),
+        "unit_of_meas": "°C",
+        "val_tpl": "{{value_json.%s|float(0)}}" % field,
+        "dev_cla": "temperature",
+        "ic": icon,
+    }
+    if field == "actual":
+        # Windowed summary of the recent samples
+        _config["json_attr_t"] = Topic("hassTopic", "stats/" + topic)
+    return Entity("sensor", object_id, _config, **kwargs)
+
+
+def _host_metric(metric, entity):
+    entity.when = lambda context: metric in context["host_metrics"]
+    return entity
+
+
+def _diagnostic(entity):
+    entity.when = lambda context: context["diagnostic_sensors"]
+    return entity
+
+
+SENSOR_ENTITIES = [
+    Entity(
+        "binary_sensor",
+        "CONNECTED",
+        {
+            "name": "Connected",
+            "stat_t": Topic("hassTopic", "Connected"),
+            "pl_on": "Connected",
+            "pl_off": "Disconnected",
+            "dev_cla": "connectivity",
+        },
+    ),
+    Entity(
+        "binary_sensor",
+        "PRINTING",
+        {
+            "name": "Printing",
+            "stat_t": Topic("hassTopic", "printing"),
+            "pl_on": "True",
+            "pl_off": "False",
+            "val_tpl": "{{value_json.state.flags.printing}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "EVENT",
+        {
+            "name": "Last event",
+            "stat_t": Topic("eventTopic", "+"),
+            "val_tpl": "{{value_json._event}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_S",
+        {
+            "name": "Print status",
+            "stat_t": Topic("hassTopic", "printing"),
+            "json_attr_t": Topic("hassTopic", "printing"),
+            "json_attr_tpl": "{{value_json.state|tojson}}",
+            "val_tpl": "{{value_json.state.text}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_P",
+        {
+            "name": "Print progress",
+            "json_attr_t": Topic("hassTopic", "printing"),
+            "json_attr_tpl": "{{value_json.progress|tojson}}",
+            "stat_t": Topic("progressTopic", "printing"),
+            "unit_of_meas": "%",
+            "val_tpl": "{{value_json.progress|float(0)}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_F",
+        {
+            "name": "Print file",
+            "stat_t": Topic("progressTopic", "printing"),
+            "val_tpl": "{{value_json.path}}",
+            "ic": "mdi:file",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_T",
+        {
+            "name": "Print time",
+            "stat_t": Topic("hassTopic", "printing"),
+            "avty": [_is_available("progress.printTime")],
+            "val_tpl": "{{value_json.progress.printTime}}",
+            "dev_cla": "duration",
+            "unit_of_meas": "s",
+            "ic": "mdi:clock-start",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_E",
+        {
+            "name": "Print time left",
+            "stat_t": Topic("hassTopic", "printing"),
+            "avty": [_is_available("progress.printTimeLeft")],
+            "val_tpl": "{{value_json.progress.printTimeLeft}}",
+            "dev_cla": "duration",
+            "unit_of_meas": "s",
+            "ic": "mdi:clock-end",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_ETA",
+        {
+            "name": "Approximate total print time",
+            "stat_t": Topic("hassTopic", "printing"),
+            "json_attr_t": Topic("hassTopic", "printing"),
+            "json_attr_tpl": "{{value_json.job|tojson}}",
+            "avty": [_is_available("job.estimatedPrintTime")],
+            "val_tpl": "{{value_json.job.estimatedPrintTime}}",
+            "dev_cla": "duration",
+            "unit_of_meas": "s",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_C",
+        {
+            "name": "Approximate completion time",
+            "stat_t": Topic("hassTopic", "printing"),
+            "avty": [_is_available("progress.printTimeLeft")],
+            "val_tpl": "{{now() + timedelta(seconds=value_json.progress.printTimeLeft|int(default=0))}}",
+            "dev_cla": "timestamp",
+        },
+    ),
+    Entity(
+        "sensor",
+        "PRINTING_Z",
+        {
+            "name": "Current Z",
+            "stat_t": Topic("hassTopic", "printing"),
+            "unit_of_meas": "mm",
+            "val_tpl": "{{value_json.currentZ|float(0)}}",
+            "ic": "mdi:axis-z-arrow",
+        },
+    ),
+    Entity(
+        "sensor",
+        "SLICING_P",
+        {
+            "name": "Slicing progress",
+            "stat_t": Topic("progressTopic", "slicing"),
+            "unit_of_meas": "%",
+            "val_tpl": "{{value_json.progress|float(0)}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "SLICING_F",
+        {
+            "name": "Slicing file",
+            "stat_t": Topic("progressTopic", "slicing"),
+            "val_tpl": "{{value_json.source_path}}",
+            "ic": "mdi:file",
+        },
+    ),
+    _temperature(
+        "TOOL{index}",
+        "Tool {index} temperature",
+        "tool{index}",
+        "actual",
+        "mdi:printer-3d-nozzle",
+        repeat=lambda context: context["extruders"],
+    ),
+    _temperature(
+        "TOOL{index}_TARGET",
+        "Tool {index} target",
+        "tool{index}",
+        "target",
+        "mdi:printer-3d-nozzle",
+        repeat=lambda context: context["extruders"],
+    ),
+    _temperature("BED", "Bed temperature", "bed", "actual", "mdi:radiator"),
+    _temperature("BED_TARGET", "Bed target", "bed", "target", "mdi:radiator"),
+    _temperature(
+        "CHAMBER",
+        "Chamber temperature",
+        "chamber",
+        "actual",
+        "mdi:radiator",
+        when=lambda context: context["heated_chamber"],
+    ),
+    _temperature(
+        "CHAMBER_TARGET",
+        "Chamber target",
+        "chamber",
+        "target",
+        "mdi:radiator",
+        when=lambda context: context["heated_chamber"],
+    ),
+    _host_metric(
+        "soc_temperature",
+        Entity(
+            "sensor",
+            "SOC",
+            {
+                "name": "SoC temperature",
+                "stat_t": Topic("temperatureTopic", "soc"),
+                "json_attr_t": Topic("hassTopic", "stats/soc"),
+                "unit_of_meas": "°C",
+                "val_tpl": "{{value_json.temperature|float(0)|round(1)}}",
+                "dev_cla": "temperature",
+                "ic": "mdi:radiator",
+            },
+        ),
+    ),
+    _host_metric(
+        "cpu_load",
+        Entity(
+            "sensor",
+            "CPU_LOAD",
+            {
+                "name": "CPU load",
+                "stat_t": Topic("hassTopic", "host/cpu_load"),
+                "unit_of_meas": "%",
+                "val_tpl": "{{value_json.value|float(0)|round(1)}}",
+                "ent_cat": "diagnostic",
+                "stat_cla": "measurement",
+                "ic": "mdi:cpu-64-bit",
+            },
+        ),
+    ),
+    _host_metric(
+        "memory",
+        Entity(
+            "sensor",
+            "MEMORY",
+            {
+                "name": "Memory used",
+                "stat_t": Topic("hassTopic", "host/memory"),
+                "unit_of_meas": "%",
+                "val_tpl": "{{value_json.value|float(0)|round(1)}}",
+                "ent_cat": "diagnostic",
+                "stat_cla": "measurement",
+                "ic": "mdi:memory",
+            },
+        ),
+    ),
+    _host_metric(
+        "disk_free",
+        Entity(
+            "sensor",
+            "DISK_FREE",
+            {
+                "name": "Disk free",
+                "stat_t": Topic("hassTopic", "host/disk_free"),
+                "unit_of_meas": "GiB",
+                "val_tpl": "{{value_json.value|float(0)|round(2)}}",
+                "ent_cat": "diagnostic",
+                "stat_cla": "measurement",
+                "ic": "mdi:harddisk",
+            },
+        ),
+    ),
+    _host_metric(
+        "throttled",
+        Entity(
+            "binary_sensor",
+            "THROTTLED",
+            {
+                "name": "Throttled",
+                "stat_t": Topic("hassTopic", "host/throttled"),
+                "json_attr_t": Topic("hassTopic", "host/throttled"),
+                "val_tpl": "{{'ON' if value_json.problem else 'OFF'}}",
+                "dev_cla": "problem",
+                "ent_cat": "diagnostic",
+            },
+        ),
+    ),
+    Entity(
+        "sensor",
+        "CADENCE",
+        {
+            "name": "Update interval",
+            "stat_t": Topic("hassTopic", "cadence"),
+            "json_attr_t": Topic("hassTopic", "cadence"),
+            "unit_of_meas": "s",
+            "val_tpl": "{{value_json.host|float(0)}}",
+            "dev_cla": "duration",
+            "ent_cat": "diagnostic",
+            "ic": "mdi:timer-sync-outline",
+        },
+    ),
+    _diagnostic(
+        Entity(
+            "sensor",
+            "MQTT_MESSAGES",
+            {
+                "name": "MQTT messages sent",
+                "stat_t": Topic("hassTopic", "diagnostics"),
+                "json_attr_t": Topic("hassTopic", "diagnostics"),
+                "json_attr_tpl": "{{value_json.classes|tojson}}",
+                "val_tpl": "{{value_json.messages}}",
+                "stat_cla": "total_increasing",
+                "ent_cat": "diagnostic",
+                "ic": "mdi:message-arrow-right-outline",
+            },
+        )
+    ),
+    _diagnostic(
+        Entity(
+            "sensor",
+            "MQTT_BYTES",
+            {
+                "name": "MQTT data sent",
+                "stat_t": Topic("hassTopic", "diagnostics"),
+                "val_tpl": "{{value_json.bytes}}",
+                "unit_of_meas": "B",
+                "dev_cla": "data_size",
+                "stat_cla": "total_increasing",
+                "ent_cat": "diagnostic",
+            },
+        )
+    ),
+    _diagnostic(
+        Entity(
+            "sensor",
+            "HANDLER_TIME",
+            {
+                "name": "Handler time",
+                "stat_t": Topic("hassTopic", "diagnostics"),
+                "val_tpl": "{{value_json.handler_time_ms|round(1)}}",
+                "unit_of_meas": "ms",
+                "stat_cla": "total_increasing",
+                "ent_cat": "diagnostic",
+                "ic": "mdi:timer-outline",
+            },
+        )
+    ),
+]
+
+CONTROL_ENTITIES = [
+    Entity(
+        "switch",
+        "CONNECT",
+        {
+            "name": "Connect to printer",
+            "cmd_t": Topic("controlTopic", "connect"),
+            "stat_t": Topic("hassTopic", "Connected"),
+            "pl_off": "False",
+            "pl_on": "True",
+            "stat_on": "Connected",
+            "stat_off": "Disconnected",
+            "ic": "mdi:lan-connect",
+        },
+    ),
+    Entity(
+        "button",
+        "STOP",
+        {
+            "name": "Emergency stop",
+            "cmd_t": Topic("controlTopic", "stop"),
+            "ic": "mdi:alert-octagon",
+        },
+    ),
+    Entity(
+        "button",
+        "CANCEL",
+        {
+            "name": "Cancel print",
+            "cmd_t": Topic("controlTopic", "cancel"),
+            "avty": [_WHILE_PRINTING],
+            "ic": "mdi:cancel",
+        },
+    ),
+    Entity(
+        "switch",
+        "PAUSE",
+        {
+            "name": "Pause print",
+            "cmd_t": Topic("controlTopic", "pause"),
+            "stat_t": Topic("hassTopic", "is_paused"),
+            "avty": [_WHILE_PRINTING],
+            "pl_off": "False",
+            "pl_on": "True",
+            "ic": "mdi:pause",
+        },
+    ),
+    Entity(
+        "button",
+        "SHUTDOWN",
+        {
+            "name": "Shutdown system",
+            "cmd_t": Topic("controlTopic", "shutdown"),
+            "ic": "mdi:power",
+        },
+    ),
+    Entity(
+        "button",
+        "REBOOT",
+        {
+            "name": "Reboot system",
+            "cmd_t": Topic("controlTopic", "reboot"),
+            "ic": "mdi:restart-alert",
+        },
+    ),
+    Entity(
+        "button",
+        "RESTART",
+        {
+            "name": "Restart server",
+            "cmd_t": Topic("controlTopic", "restart"),
+            "ic": "mdi:restart",
+        },
+    ),
+    Entity(
+        "switch",
+        "PSU",
+        {
+            "name": "PSU",
+            "cmd_t": Topic("controlTopic", "psu"),
+            "stat_t": Topic("hassTopic", "psu_on"),
+            "pl_on": "True",
+            "pl_off": "False",
+            "ic": "mdi:flash",
+        },
+        when=lambda context: context["psucontrol"],
+    ),
+    Entity(
+        "switch",
+        "CAMERA_SNAPSHOT",
+        {
+            "name": "Camera snapshot",
+            "cmd_t": Topic("controlTopic", "camera_snapshot"),
+            "stat_t": Topic("controlTopic", "camera_snapshot"),
+            "pl_off": "False",
+            "pl_on": "True",
+            "val_tpl": "{{False}}",
+            "ic": "mdi:camera-iris",
+        },
+        when=lambda context: context["snapshot"],
+    ),
+    Entity(
+        "sensor",
+        "COMMAND_QUEUE",
+        {
+            "name": "Command queue",
+            "stat_t": Topic("hassTopic", "commands"),
+            "json_attr_t": Topic("hassTopic", "commands"),
+            "val_tpl": "{{value_json.queued|int(0)}}",
+            "unit_of_meas": "commands",
+            "ent_cat": "diagnostic",
+            "ic": "mdi:format-list-numbered",
+        },
+    ),
+]
+
+
+# Fields of a JSON payload read by a Home Assistant template
+_TEMPLATE_FIELD = re.compile(r"value_json((?:\.[A-Za-z_]\w*)+)")
+
+# Topic keys and the template keys that read their payload
+_TEMPLATE_KEYS = (("stat_t", "val_tpl"), ("json_attr_t", "json_attr_tpl"), ("t", "val_tpl"))
+
+
+def referenced_fields(entities, topic):
+    """Returns the dotted paths of the fields templates read from a topic.
+
+    Covers the state, attributes and availability templates of every entity,
+    whatever their conditions, so the result doesn't depend on the printer.
+    """
+    _fields = set()
+    _configs = []
+    for entity in entities:
+        _configs.append(entity.config)
+        _configs.extend(entity.config.get("avty", []))
+    for config in _configs:
+        for topic_key, template_key in _TEMPLATE_KEYS:
+            if config.get(topic_key) == topic and template_key in config:
+                for match in _TEMPLATE_FIELD.finditer(config[template_key]):
+                    _fields.add(match.group(1)[1:])
+    return _fields
+
+
+def split_fields(entities, topic):
+    """Returns the referenced fields of a topic that no other one is part of.
+
+    These are the scalar values that can be published to topics of their own.
+    """
+    _fields = referenced_fields(entities, topic)
+    return set(
+        field
+        for field in _fields
+        if not any(other.startswith(field + ".") for other in _fields)
+    )
+
+
+def _split_config(config, topic, fields):
+    # Points templates reading a single split field at the topic of that
+    # field, its payload is the JSON encoded value so value_json still works
+    _config = dict(config)
+    for topic_key, template_key in _TEMPLATE_KEYS:
+        if _config.get(topic_key) != topic or template_key not in _config:
+            continue
+        _paths = set(
+            match.group(1)[1:]
+            for match in _TEMPLATE_FIELD.finditer(_config[template_key])
+        )
+        if len(_paths) != 1 or not _paths <= fields:
+            continue
+        _path = _paths.pop()
+        _config[topic_key] = Topic(
+            topic.topic_type, topic.topic + "/" + _path.replace(".", "/")
+        )
+        _config[template_key] = _config[template_key].replace(
+            "value_json." + _path, "value_json"
+        )
+    if "avty" in _config:
+        _config["avty"] = [_split_config(a, topic, fields) for a in _config["avty"]]
+    return _config
+
+
+def _resolve(value, index, resolve_topic):
+    if isinstance(value, Topic):
+        return resolve_topic(
+            value.topic_type, _resolve(value.topic, index, resolve_topic)
+        )
+    if isinstance(value, str):
+        return value if index is None else value.replace("{index}", str(index))
+    if isinstance(value, dict):
+        return dict((k, _resolve(v, index, resolve_topic)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_resolve(v, index, resolve_topic) for v in value]
+    return value
+
+
+def _expand(entities, context, resolve_topic, split):
+    for entity in entities:
+        if entity.when and not entity.when(context):
+            continue
+        _config = entity.config
+        if split:
+            _config = _split_config(_config, *split)
+        for index in range(entity.repeat(context)) if entity.repeat else (None,):
+            yield (
+                entity.component,
+                _resolve(entity.object_id, index, None),
+                _resolve(_config, index, resolve_topic),
+            )
+
+
+def compile_entities(
+    entities,
+    context,
+    resolve_topic,
+    discovery_topic,
+    node_id,
+    common,
+    availability,
+    split=None,
+):
+    """Compiles entities into a list of (config topic, serialized payload).
+
+    resolve_topic(topic_type, topic) returns the value of a Topic reference,
+    common holds the values shared by every entity and availability is
+    appended to the availability list of each one. split is a (Topic, fields)
+    pair, templates reading one of these fields read its own topic instead.
+    """
+    _compiled = []
+    for component, object_id, config in _expand(
+        entities, context, resolve_topic, split
+    ):
+        _object_id = node_id + "_" + object_id
+        _payload = dict(common)
+        _payload["uniq_id"] = _object_id
+        _payload.update(config)
+        _payload["avty"] = _payload.get("avty", []) + [availability]
+        _compiled.append(
+            (
+                "/".join((discovery_topic, component, _object_id, "config")),
+                json.dumps(_payload, sort_keys=True),
+            )
+        )
+    return _compiled
+
+
+def compile_device(
+    entities,
+    context,
+    resolve_topic,
+    discovery_topic,
+    node_id,
+    common,
+    availability,
+    origin,
+    split=None,
+):
+    """Compiles entities into a single device based discovery message.
+
+    The device, base topic and availability are shared by all components,
+    components with availability entries of their own still get the
+    default one appended as they replace the shared list.
+    """
+    _components = {}
+    for component, object_id, config in _expand(
+        entities, context, resolve_topic, split
+    ):
+        _object_id = node_id + "_" + object_id
+        _config = dict(config, p=component, uniq_id=_object_id)
+        if "avty" in _config:
+            _config["avty"] = _config["avty"] + [availability]
+        _components[_object_id] = _config
+
+    _payload = dict(common, avty=[availability], o=origin, cmps=_components)
+    return [
+        (
+            "/".join((discovery_topic, "device", node_id, "config")),
+            json.dumps(_payload, sort_keys=True),
+        )
+    ]
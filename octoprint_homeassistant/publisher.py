@@ -0,0 +1,265 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import threading
+import time
+
+# Telemetry drops the oldest message when the queue is full, state only keeps
+# the last value per topic. Command acknowledgements, such as the status of
+# the command queue, and discovery are never dropped from the queue.
+PUBLISH_TELEMETRY = "telemetry"
+PUBLISH_STATE = "state"
+PUBLISH_COMMAND = "command"
+PUBLISH_DISCOVERY = "discovery"
+
+PUBLISH_CLASSES = (
+    PUBLISH_COMMAND,
+    PUBLISH_DISCOVERY,
+    PUBLISH_STATE,
+    PUBLISH_TELEMETRY,
+)
+
+
+def payload_size(payload):
+    if isinstance(payload, (bytes, str)):
+        return len(payload)
+    try:
+        return len(json.dumps(payload))
+    except (TypeError, ValueError):
+        return 0
+
+
+class PublishWorker(object):
+    """Publishes MQTT messages from a dedicated thread.
+
+    Handing a message off with submit() is O(1) and never blocks on the
+    broker, so it is safe to call from OctoPrint's event and comm threads.
+
+    Messages the broker couldn't take while disconnected are kept in an
+    offline buffer, only the last one per topic and up to offline_max_bytes.
+    Once a publish succeeds again they are flushed, paced by flush_bucket.
+    """
+
+    def __init__(
+        self,
+        max_size=100,
+        logger=None,
+        metrics=None,
+        offline_max_bytes=262144,
+        flush_bucket=None,
+    ):
+        self._logger = logger or logging.getLogger(__name__)
+        self._metrics = metrics
+        self._max_size = max_size
+        self._offline = collections.OrderedDict()
+        self._offline_bytes = 0
+        self._offline_max_bytes = offline_max_bytes
+        self._flushing = collections.OrderedDict()
+        self._flush_bucket = flush_bucket
+        self._cond = threading.Condition()
+        self._queues = {
+            PUBLISH_COMMAND: collections.deque(),
+            PUBLISH_DISCOVERY: collections.deque(),
+            PUBLISH_STATE: collections.OrderedDict(),
+            PUBLISH_TELEMETRY: collections.deque(maxlen=max_size),
+        }
+        self._limits = {}
+        self._thread = None
+        self._running = False
+        self.dropped = dict((c, 0) for c in PUBLISH_CLASSES)
+
+    def set_rate_limit(self, publish_class, bucket):
+        """Throttles a class with a TokenBucket, other classes keep flowing."""
+        with self._cond:
+            self._limits[publish_class] = bucket
+            self._cond.notify_all()
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._run, name="homeassistant-publish"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, publish_class, topic, payload, publish, **kwargs):
+        with self._cond:
+            self._enqueue((publish_class, topic, payload, publish, kwargs))
+            self._cond.notify_all()
+
+    def _enqueue(self, entry):
+        publish_class, topic = entry[0], entry[1]
+        # A newer message supersedes whatever is still buffered for the topic
+        self._drop_offline(topic)
+        self._flushing.pop(topic, None)
+
+        queue = self._queues[publish_class]
+        if publish_class == PUBLISH_STATE:
+            if topic not in queue and len(queue) >= self._max_size:
+                queue.popitem(last=False)
+                self.dropped[publish_class] += 1
+            queue[topic] = entry
+        else:
+            if publish_class == PUBLISH_TELEMETRY and len(queue) == queue.maxlen:
+                self.dropped[publish_class] += 1
+            queue.append(entry)
+
+    def submit_many(self, publish_class, messages, publish, **kwargs):
+        """Queues a list of (topic, payload) under a single lock acquisition."""
+        self.submit_entries(
+            (publish_class, topic, payload, publish, kwargs)
+            for topic, payload in messages
+        )
+
+    def submit_entries(self, entries):
+        """Queues (publish_class, topic, payload, publish, kwargs) entries."""
+        with self._cond:
+            for entry in entries:
+                self._enqueue(entry)
+            self._cond.notify_all()
+
+    def wait_drained(self, publish_class, timeout=None):
+        """Blocks until a class has been handed to the broker, or timeout."""
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queues[publish_class] and self._running:
+                _remaining = None
+                if _deadline is not None:
+                    _remaining = _deadline - time.monotonic()
+                    if _remaining <= 0:
+                        return False
+                self._cond.wait(_remaining)
+            return True
+
+    def pending(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values()) + len(self._flushing)
+
+    def offline(self):
+        with self._cond:
+            return {
+                "buffered": len(self._offline),
+                "bytes": self._offline_bytes,
+                "flushing": len(self._flushing),
+            }
+
+    def _buffer_offline(self, entry):
+        publish_class, topic, payload, _, kwargs = entry
+        _size = payload_size(payload)
+        # Raw payloads are camera images, large and stale by the next one
+        if kwargs.get("raw_data") or _size > self._offline_max_bytes:
+            self.dropped[publish_class] += 1
+            return
+
+        self._drop_offline(topic)
+        self._offline[topic] = (entry, _size)
+        self._offline_bytes += _size
+        while self._offline_bytes > self._offline_max_bytes:
+            _entry, _dropped_size = self._offline.popitem(last=False)[1]
+            self._offline_bytes -= _dropped_size
+            self.dropped[_entry[0]] += 1
+
+    def _drop_offline(self, topic):
+        _buffered = self._offline.pop(topic, None)
+        if _buffered:
+            self._offline_bytes -= _buffered[1]
+
+    def _flush_offline(self):
+        if self._offline:
+            self._logger.debug(
+                "Reconnected, flushing %d buffered messages", len(self._offline)
+            )
+        for topic, (entry, _) in self._offline.items():
+            self._flushing[topic] = entry
+        self._offline.clear()
+        self._offline_bytes = 0
+
+    def _next(self):
+        # Returns the next entry, or None and how long to wait for a token
+        _wait = None
+        for publish_class in PUBLISH_CLASSES:
+            queue = self._queues[publish_class]
+            if not queue:
+                continue
+            bucket = self._limits.get(publish_class)
+            if bucket:
+                _delay = bucket.take()
+                if _delay:
+                    _wait = _delay if _wait is None else min(_wait, _delay)
+                    continue
+            if publish_class == PUBLISH_STATE:
+                return queue.popitem(last=False)[1], None
+            return queue.popleft(), None
+
+        # Buffered messages go out after everything fresh, at the flush rate
+        if self._flushing:
+            _delay = self._flush_bucket.take() if self._flush_bucket else 0
+            if not _delay:
+                return self._flushing.popitem(last=False)[1], None
+            _wait = _delay if _wait is None else min(_wait, _delay)
+        return None, _wait
+
+    def run_pending(self):
+        """Publishes the messages that are due on the calling thread.
+
+        Lets a harness drive a worker that wasn't started, returns the
+        number of messages handed to the broker.
+        """
+        _count = 0
+        while True:
+            with self._cond:
+                entry, _ = self._next()
+                if entry is None:
+                    return _count
+                self._cond.notify_all()
+            self._publish_entry(entry)
+            _count += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                entry, _wait = self._next()
+                while entry is None and self._running:
+                    self._cond.wait(_wait)
+                    entry, _wait = self._next()
+                if entry is None:
+                    return
+                self._cond.notify_all()
+            self._publish_entry(entry)
+
+    def _publish_entry(self, entry):
+        publish_class, topic, payload, publish, kwargs = entry
+        _start = time.perf_counter()
+        _ok = False
+        try:
+            _ok = publish(topic, payload, **kwargs) is not False
+            with self._cond:
+                if not _ok:
+                    # Disconnected from the broker
+                    self._buffer_offline(entry)
+                elif self._offline:
+                    self._flush_offline()
+        except Exception:
+            self._logger.exception("Unable to publish message to %s", topic)
+
+        if self._metrics:
+            self._metrics.record_publish(
+                publish_class,
+                payload_size(payload),
+                time.perf_counter() - _start,
+                _ok,
+            )
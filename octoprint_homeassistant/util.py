@@ -0,0 +1,274 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import array
+import bisect
+import hashlib
+import math
+import threading
+import time
+
+
+class AdaptiveInterval(object):
+    """Timer interval that follows how busy the printer is.
+
+    The interval drops to the floor while busy, is halved when the last tick
+    saw changing values and doubles, up to the ceiling, when nothing changed.
+    Pass current() as the interval of a RepeatedTimer to apply it.
+    """
+
+    def __init__(self, floor, ceiling, factor=2.0):
+        self._lock = threading.Lock()
+        self.floor = floor
+        self.ceiling = ceiling
+        self.factor = factor
+        self.interval = floor
+
+    def configure(self, floor, ceiling):
+        with self._lock:
+            self.floor = floor
+            self.ceiling = max(floor, ceiling)
+            self.interval = min(max(self.interval, self.floor), self.ceiling)
+
+    def current(self):
+        return self.interval
+
+    def reset(self):
+        with self._lock:
+            self.interval = self.floor
+
+    def update(self, changed, busy=False):
+        with self._lock:
+            if busy:
+                self.interval = self.floor
+            elif changed:
+                self.interval = max(self.floor, self.interval / self.factor)
+            else:
+                self.interval = min(self.ceiling, self.interval * self.factor)
+            return self.interval
+
+
+class TokenBucket(object):
+    """Allows bursts of up to burst events, refilled at rate per second."""
+
+    def __init__(self, rate, burst):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def take(self):
+        """Takes a token, returns 0 or the seconds until one is available."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0
+            _now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (_now - self._updated) * self.rate
+            )
+            self._updated = _now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RingBuffer(object):
+    """Fixed size history of timestamped samples, backed by arrays of doubles.
+
+    Once full the oldest sample is overwritten, so the memory used never
+    changes after construction.
+    """
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._times = array.array("d", [0.0]) * size
+        self._values = array.array("d", [0.0]) * size
+        self._size = size
+        self._next = 0
+        self.count = 0
+
+    def append(self, value, now=None):
+        with self._lock:
+            self._times[self._next] = time.monotonic() if now is None else now
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self._size
+            self.count = min(self.count + 1, self._size)
+
+    def summary(self, window, now=None):
+        """Returns min, max, mean and stddev of the last window seconds.
+
+        Returns None when no sample falls in the window.
+        """
+        _since = (time.monotonic() if now is None else now) - window
+        _count = 0
+        _mean = _m2 = 0.0
+        _min = _max = None
+        with self._lock:
+            # Walk back from the newest sample, Welford's method for the variance
+            _index = self._next
+            for _ in range(self.count):
+                _index = (_index - 1) % self._size
+                if self._times[_index] < _since:
+                    break
+                value = self._values[_index]
+                _count += 1
+                _delta = value - _mean
+                _mean += _delta / _count
+                _m2 += _delta * (value - _mean)
+                if _min is None or value < _min:
+                    _min = value
+                if _max is None or value > _max:
+                    _max = value
+
+        if not _count:
+            return None
+        return {
+            "count": _count,
+            "min": _min,
+            "max": _max,
+            "mean": _mean,
+            "stddev": math.sqrt(_m2 / _count),
+        }
+
+
+def node_jitter(node_id, spread):
+    """Deterministic delay in [0, spread) seconds, spreading nodes apart."""
+    _digest = hashlib.sha1(str(node_id).encode("utf-8")).hexdigest()
+    return int(_digest[:8], 16) / float(0x100000000) * spread
+
+
+def compile_projection(fields):
+    """Compiles dotted field paths into a function that copies only them.
+
+    A path selects the whole value at its end, paths below one that is
+    already selected are ignored and missing fields are skipped.
+    """
+    _tree = {}
+    for field in fields:
+        _node = _tree
+        _parts = field.split(".")
+        for part in _parts[:-1]:
+            _node = _node.setdefault(part, {})
+            if _node is True:
+                break
+        else:
+            _node[_parts[-1]] = True
+
+    return _compile_projection_node(_tree)
+
+
+def _compile_projection_node(node):
+    _fields = [
+        (key, None if child is True else _compile_projection_node(child))
+        for key, child in node.items()
+    ]
+
+    def project(data):
+        _projected = {}
+        for key, child in _fields:
+            if key in data:
+                value = data[key]
+                if child is not None and isinstance(value, dict):
+                    value = child(value)
+                _projected[key] = value
+        return _projected
+
+    return project
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram(object):
+    """Fixed bucket latency histogram, the last bucket counts everything slower."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total * 1000.0 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000.0,
+            "buckets_ms": dict(
+                zip(
+                    [str(b * 1000.0) for b in self.buckets] + ["+Inf"],
+                    self.counts,
+                )
+            ),
+        }
+
+
+class Metrics(object):
+    """Counters and latency histograms for publishes and handlers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._publishes = {}
+        self._handlers = {}
+        self.started = time.time()
+
+    def record_publish(self, publish_class, size, duration, ok=True):
+        with self._lock:
+            _stats = self._publishes.get(publish_class)
+            if _stats is None:
+                _stats = self._publishes[publish_class] = {
+                    "messages": 0,
+                    "bytes": 0,
+                    "failed": 0,
+                    "latency": Histogram(),
+                }
+            _stats["messages"] += 1
+            _stats["bytes"] += size
+            if not ok:
+                _stats["failed"] += 1
+            _stats["latency"].record(duration)
+
+    def record_handler(self, name, duration):
+        with self._lock:
+            _histogram = self._handlers.get(name)
+            if _histogram is None:
+                _histogram = self._handlers[name] = Histogram()
+            _histogram.record(duration)
+
+    def totals(self):
+        with self._lock:
+            return {
+                "messages": sum(s["messages"] for s in self._publishes.values()),
+                "bytes": sum(s["bytes"] for s in self._publishes.values()),
+                "handler_calls": sum(h.count for h in self._handlers.values()),
+                "handler_time_ms": sum(h.total for h in self._handlers.values())
+                * 1000.0,
+            }
+
+    def as_dict(self):
+        with self._lock:
+            publishes = {}
+            for publish_class, stats in self._publishes.items():
+                publishes[publish_class] = dict(stats, latency=stats["latency"].as_dict())
+            handlers = dict((k, v.as_dict()) for k, v in self._handlers.items())
+        return {
+            "uptime": time.time() - self.started,
+            "publishes": publishes,
+            "handlers": handlers,
+        }
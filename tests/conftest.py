@@ -0,0 +1,44 @@
+# coding=utf-8
+"""Shared fixtures, the plugin tests reuse the stand-ins of the benchmarks.
+
+The octoprint_homeassistant package imports OctoPrint, so the tests need it
+installed in the same environment, like the plugin itself.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+)
+
+from fakes import create_plugin, stop_plugin  # noqa: E402
+
+
+def wait_for(predicate, timeout=2.0):
+    """Polls predicate until it holds or the timeout expires."""
+    _deadline = time.monotonic() + timeout
+    while time.monotonic() < _deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def make_plugin():
+    """Returns a factory of started plugins, stopped again after the test."""
+    _plugins = []
+
+    def factory(**kwargs):
+        plugin, mqtt = create_plugin(**kwargs)
+        _plugins.append(plugin)
+        return plugin, mqtt
+
+    yield factory
+    for plugin in _plugins:
+        stop_plugin(plugin)
@@ -0,0 +1,130 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+
+import pytest
+from conftest import wait_for
+
+from octoprint_homeassistant.commands import CommandQueue, parse_commands
+
+
+@pytest.mark.parametrize(
+    "payload, expected",
+    [
+        ("G28", ["G28"]),
+        ('"G28"', ["G28"]),
+        ('["G28", "G1 Z10"]', ["G28", "G1 Z10"]),
+        ("G28\nM104 S200 ; heat\n\n; comment only\n  G1 Z10  ", ["G28", "M104 S200", "G1 Z10"]),
+        ('["G28\\nG29", "M500"]', ["G28", "G29", "M500"]),
+        ("", []),
+    ],
+)
+def test_parse_commands(payload, expected):
+    assert parse_commands(payload) == expected
+
+
+@pytest.mark.parametrize("payload", ["42", '{"command": "G28"}', '["G28", 1]'])
+def test_parse_commands_rejects_other_types(payload):
+    with pytest.raises(ValueError):
+        parse_commands(payload)
+
+
+@pytest.fixture
+def make_queue():
+    _queues = []
+
+    def factory(**kwargs):
+        sent = []
+        reports = []
+        queue = CommandQueue(sent.append, reports.append, **kwargs)
+        _queues.append(queue)
+        return queue, sent, reports
+
+    yield factory
+    for queue in _queues:
+        queue.stop(timeout=5)
+
+
+def test_queue_sends_in_chunks(make_queue):
+    queue, sent, reports = make_queue(chunk_size=2, rate=0)
+    assert queue.submit(["G%d" % i for i in range(5)])
+    queue.start()
+
+    assert wait_for(lambda: queue.status()["state"] == "idle" and queue.sent == 5)
+    assert sent == [["G0", "G1"], ["G2", "G3"], ["G4"]]
+    assert reports[0]["queued"] == 5
+    assert reports[-1]["state"] == "idle"
+    assert reports[-1]["sent"] == 5
+
+
+def test_queue_is_rate_limited(make_queue):
+    queue, sent, _ = make_queue(chunk_size=1, rate=5)
+    queue.start()
+    queue.submit(["G%d" % i for i in range(5)])
+
+    # One line every 200 ms
+    assert not wait_for(lambda: len(sent) == 5, timeout=0.3)
+    assert 1 <= len(sent) < 5
+    assert wait_for(lambda: len(sent) == 5)
+
+
+def test_queue_rate_limit_holds_while_jobs_arrive(make_queue):
+    queue, sent, _ = make_queue(chunk_size=1, rate=2)
+    queue.start()
+    queue.submit(["G0"])
+    assert wait_for(lambda: sent)
+    for i in range(1, 11):
+        queue.submit(["G%d" % i])
+
+    # Each submit wakes the thread, none of them may shorten the 500 ms slot
+    assert not wait_for(lambda: len(sent) > 1, timeout=0.3)
+    assert wait_for(lambda: len(sent) == 2)
+
+
+def test_queue_stop_cuts_the_rate_wait_short(make_queue):
+    queue, sent, _ = make_queue(chunk_size=1, rate=0.1)
+    queue.start()
+    queue.submit(["G0", "G1"])
+    assert wait_for(lambda: sent)
+
+    _start = time.monotonic()
+    queue.stop(timeout=5)
+    assert time.monotonic() - _start < 1
+    assert sent == [["G0"]]
+
+
+def test_queue_rejects_jobs_over_max_size(make_queue):
+    queue, _, _ = make_queue(max_size=3)
+    assert queue.submit(["G1", "G2"])
+    assert not queue.submit(["G3", "G4"])
+
+    _status = queue.status()
+    assert _status["queued"] == 2
+    assert _status["jobs"] == 1
+    assert _status["rejected"] == 2
+
+
+def test_queue_clear(make_queue):
+    queue, sent, reports = make_queue()
+    queue.submit(["G1", "G2", "G3"])
+
+    assert queue.clear() == 3
+    assert queue.clear() == 0
+    assert queue.status()["queued"] == 0
+    assert reports[-1]["state"] == "idle"
+
+
+def test_queue_counts_failures(make_queue):
+    def send(lines):
+        raise RuntimeError("Printer is not operational")
+
+    queue = CommandQueue(send, rate=0)
+    queue.start()
+    try:
+        queue.submit(["G28", "G29"])
+        assert wait_for(lambda: queue.failed == 2)
+    finally:
+        queue.stop(timeout=5)
+
+    assert queue.sent == 0
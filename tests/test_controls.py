@@ -0,0 +1,87 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import pytest
+
+
+@pytest.fixture
+def controls(make_plugin):
+    plugin, mqtt = make_plugin()
+
+    def send(control, payload):
+        mqtt.deliver(plugin._generate_topic("controlTopic", control, full=True), payload)
+
+    return plugin, mqtt, send
+
+
+def test_controls_share_a_wildcard_subscription(controls):
+    plugin, mqtt, _ = controls
+    _prefix = plugin._generate_topic("controlTopic", "", full=True)
+
+    _topics = [topic for topic, _ in mqtt.subscriptions]
+    assert [topic for topic in _topics if topic.startswith(_prefix)] == [_prefix + "+"]
+
+
+@pytest.mark.parametrize(
+    "control, payload, expected",
+    [
+        ("pause", "True", {"paused": True}),
+        ("connect", "False", {"connection": "Closed"}),
+        ("cancel", "PRESS", {"printing": False}),
+    ],
+)
+def test_controls_are_routed_to_their_handler(controls, control, payload, expected):
+    plugin, _, send = controls
+    plugin._printer.printing = True
+    send(control, payload)
+
+    for name, value in expected.items():
+        assert getattr(plugin._printer, name) == value
+
+
+def test_stop_clears_the_command_queue(controls):
+    plugin, _, send = controls
+    plugin._command_queue.stop(timeout=5)
+    plugin._command_queue.submit(["G28", "G29"])
+    send("stop", "PRESS")
+
+    assert plugin._printer.commands_sent == ["M112"]
+    assert plugin._command_queue.status()["queued"] == 0
+
+
+@pytest.mark.parametrize(
+    "control, payload",
+    [
+        ("pause", "Maybe"),
+        ("stop", "True"),
+        ("cancel", b"\xff\xfe"),
+    ],
+)
+def test_unexpected_payloads_are_rejected(controls, control, payload):
+    plugin, _, send = controls
+    plugin._printer.printing = True
+    send(control, payload)
+
+    assert not plugin._printer.paused
+    assert plugin._printer.printing
+    assert plugin._printer.commands_sent == []
+
+
+def test_invalid_json_is_rejected(controls):
+    plugin, _, send = controls
+    plugin._jog_window = 0
+    send("jog", "{x: 1")
+    send("jog", '{"x": 1}')
+
+    assert plugin._printer.jogs == [({"x": 1.0}, None)]
+
+
+def test_unknown_and_disabled_controls_are_ignored(controls, monkeypatch):
+    plugin, _, send = controls
+    calls = []
+    monkeypatch.setattr(plugin, "_on_camera", lambda *args, **kwargs: calls.append(args))
+    assert not plugin.snapshot_enabled
+
+    send("unknown", "PRESS")
+    send("camera_snapshot", "PRESS")
+    assert calls == []
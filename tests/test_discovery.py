@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from conftest import wait_for
+
+from octoprint_homeassistant.util import node_jitter
+
+
+def _started(make_plugin, **settings):
+    # No discovery rate limit, the configs go out right away
+    settings.update(discovery_rate=0)
+    plugin, mqtt = make_plugin(settings=settings)
+    _status = plugin._generate_topic("hassTopic", "printing", full=True)
+    assert wait_for(
+        lambda: _status in plugin._state_cache
+        and plugin._publish_worker.pending() == 0
+    )
+    return plugin, mqtt
+
+
+def _lwt(plugin):
+    return plugin._generate_topic("lwTopic", "", full=True)
+
+
+def test_reconnect_schedules_a_jittered_rediscovery(make_plugin):
+    plugin, mqtt = _started(make_plugin, rediscovery_jitter=30)
+
+    mqtt.deliver(_lwt(plugin), "connected")
+    _timer = plugin._rediscovery_timer
+    assert _timer is not None
+    assert _timer.interval == node_jitter("BENCH1", 30)
+
+    # Home Assistant coming back meanwhile is merged into the pending one
+    mqtt.deliver("homeassistant/status", "online")
+    assert plugin._rediscovery_timer is _timer
+
+
+def test_other_lwt_messages_are_ignored(make_plugin):
+    plugin, mqtt = _started(make_plugin, rediscovery_jitter=30)
+
+    mqtt.deliver(_lwt(plugin), "disconnected")
+    mqtt.deliver("homeassistant/status", "offline")
+    assert plugin._rediscovery_timer is None
+
+
+def test_rediscovery_republishes_then_replays(make_plugin):
+    plugin, mqtt = _started(make_plugin, rediscovery_jitter=0)
+    _configs = set(plugin._discovery_cache)
+    _status = plugin._generate_topic("hassTopic", "printing", full=True)
+    mqtt.reset()
+    mqtt.record = True
+
+    mqtt.deliver(_lwt(plugin), "connected")
+    assert wait_for(
+        lambda: plugin._rediscovery_timer is None and mqtt.messages[_status] == 1
+    )
+    assert wait_for(lambda: plugin._publish_worker.pending() == 0)
+
+    _topics = [topic for _, topic, _ in mqtt.published]
+    assert set(_topics) >= _configs
+    assert all(mqtt.messages[topic] == 1 for topic in _configs)
+    assert set(plugin._discovery_cache) == _configs
+    # The configs go out before the states, which come from the cache
+    assert max(_topics.index(topic) for topic in _configs) < _topics.index(_status)
+    # The LWT is not replayed, it would trigger another rediscovery
+    assert mqtt.messages[_lwt(plugin)] == 0
+    assert plugin._rediscovery_timer is None
@@ -0,0 +1,171 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+
+from octoprint_homeassistant.entities import (
+    SENSOR_ENTITIES,
+    Entity,
+    Topic,
+    compile_device,
+    compile_entities,
+    referenced_fields,
+    split_fields,
+)
+
+PRINTING = Topic("hassTopic", "printing")
+
+ENTITIES = [
+    Entity(
+        "sensor",
+        "PROGRESS",
+        {
+            "name": "Progress",
+            "stat_t": PRINTING,
+            "val_tpl": "{{value_json.progress.completion}}",
+            "json_attr_t": PRINTING,
+            "json_attr_tpl": "{{value_json.progress|tojson}}",
+        },
+    ),
+    Entity(
+        "sensor",
+        "TOOL{index}",
+        {
+            "name": "Tool {index}",
+            "stat_t": Topic("hassTopic", "temperature/tool{index}"),
+            "val_tpl": "{{value_json.actual}}",
+        },
+        repeat=lambda context: context["extruders"],
+    ),
+    Entity(
+        "sensor",
+        "Z",
+        {
+            "name": "Z",
+            "stat_t": PRINTING,
+            "avty": [
+                {
+                    "t": PRINTING,
+                    "val_tpl": "{{'True' if value_json.currentZ else 'False'}}",
+                }
+            ],
+            "val_tpl": "{{value_json.currentZ}}",
+        },
+        when=lambda context: context["z"],
+    ),
+]
+
+AVAILABILITY = {"t": "~mqtt", "pl_avail": "connected", "pl_not_avail": "disconnected"}
+
+
+def _resolve_topic(topic_type, topic):
+    return "~" + topic_type + "/" + topic
+
+
+def _compile(context, split=None):
+    return compile_entities(
+        ENTITIES,
+        context,
+        _resolve_topic,
+        discovery_topic="homeassistant",
+        node_id="ABC123",
+        common={"~": "octoPrint/"},
+        availability=AVAILABILITY,
+        split=split,
+    )
+
+
+def test_referenced_fields():
+    assert referenced_fields(ENTITIES, PRINTING) == set(
+        ["progress", "progress.completion", "currentZ"]
+    )
+
+
+def test_referenced_fields_of_the_plugin_entities():
+    _fields = referenced_fields(SENSOR_ENTITIES, PRINTING)
+    assert "state.text" in _fields
+    assert "progress.printTimeLeft" in _fields
+    assert "offsets" not in _fields
+
+
+def test_split_fields_skips_parents():
+    assert split_fields(ENTITIES, PRINTING) == set(["progress.completion", "currentZ"])
+
+
+def test_compile_entities():
+    _compiled = dict(_compile({"extruders": 2, "z": True}))
+
+    assert sorted(_compiled) == [
+        "homeassistant/sensor/ABC123_PROGRESS/config",
+        "homeassistant/sensor/ABC123_TOOL0/config",
+        "homeassistant/sensor/ABC123_TOOL1/config",
+        "homeassistant/sensor/ABC123_Z/config",
+    ]
+    tool = json.loads(_compiled["homeassistant/sensor/ABC123_TOOL1/config"])
+    assert tool == {
+        "~": "octoPrint/",
+        "name": "Tool 1",
+        "uniq_id": "ABC123_TOOL1",
+        "stat_t": "~hassTopic/temperature/tool1",
+        "val_tpl": "{{value_json.actual}}",
+        "avty": [AVAILABILITY],
+    }
+    z = json.loads(_compiled["homeassistant/sensor/ABC123_Z/config"])
+    assert len(z["avty"]) == 2
+    assert z["avty"][-1] == AVAILABILITY
+
+
+def test_compile_entities_conditions():
+    _compiled = dict(_compile({"extruders": 0, "z": False}))
+    assert list(_compiled) == ["homeassistant/sensor/ABC123_PROGRESS/config"]
+
+
+def test_compile_entities_is_stable():
+    assert _compile({"extruders": 1, "z": True}) == _compile(
+        {"extruders": 1, "z": True}
+    )
+
+
+def test_compile_entities_split():
+    _split = (PRINTING, frozenset(split_fields(ENTITIES, PRINTING)))
+    _compiled = dict(_compile({"extruders": 0, "z": True}, split=_split))
+
+    progress = json.loads(_compiled["homeassistant/sensor/ABC123_PROGRESS/config"])
+    assert progress["stat_t"] == "~hassTopic/printing/progress/completion"
+    assert progress["val_tpl"] == "{{value_json}}"
+    # The attributes read a whole object, they stay on the full status
+    assert progress["json_attr_t"] == "~hassTopic/printing"
+
+    z = json.loads(_compiled["homeassistant/sensor/ABC123_Z/config"])
+    assert z["stat_t"] == "~hassTopic/printing/currentZ"
+    assert z["avty"][0]["t"] == "~hassTopic/printing/currentZ"
+
+
+def test_compile_device():
+    _origin = {"name": "OctoPrint-HomeAssistant", "sw": "1.0"}
+    _compiled = compile_device(
+        ENTITIES,
+        {"extruders": 1, "z": True},
+        _resolve_topic,
+        discovery_topic="homeassistant",
+        node_id="ABC123",
+        common={"~": "octoPrint/"},
+        availability=AVAILABILITY,
+        origin=_origin,
+    )
+
+    assert len(_compiled) == 1
+    topic, payload = _compiled[0]
+    assert topic == "homeassistant/device/ABC123/config"
+
+    payload = json.loads(payload)
+    assert payload["o"] == _origin
+    assert payload["avty"] == [AVAILABILITY]
+    assert sorted(payload["cmps"]) == ["ABC123_PROGRESS", "ABC123_TOOL0", "ABC123_Z"]
+
+    tool = payload["cmps"]["ABC123_TOOL0"]
+    assert tool["p"] == "sensor"
+    assert tool["uniq_id"] == "ABC123_TOOL0"
+    assert "avty" not in tool
+    # Components with availability of their own keep the shared one too
+    assert payload["cmps"]["ABC123_Z"]["avty"][-1] == AVAILABILITY
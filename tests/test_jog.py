@@ -0,0 +1,68 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+
+import pytest
+from conftest import wait_for
+
+
+@pytest.fixture
+def jog(make_plugin):
+    plugin, mqtt = make_plugin(settings={"jog_coalesce_window": 0.1})
+    _topic = plugin._generate_topic("controlTopic", "jog", full=True)
+
+    def send(**move):
+        mqtt.deliver(_topic, json.dumps(move))
+
+    return plugin, send
+
+
+def test_jogs_within_the_window_are_summed(jog):
+    plugin, send = jog
+    send(x=1)
+    send(x=1, z=0.5)
+    send(x=1, y=-2)
+
+    assert wait_for(lambda: plugin._printer.jogs)
+    assert plugin._printer.jogs == [({"x": 3.0, "y": -2.0, "z": 0.5}, None)]
+
+
+def test_summed_jogs_are_capped(jog):
+    plugin, send = jog
+    send(x=40)
+    send(x=40, y=-40)
+    send(y=-40)
+
+    assert wait_for(lambda: plugin._printer.jogs)
+    assert plugin._printer.jogs == [({"x": 50.0, "y": -50.0}, None)]
+
+
+def test_moves_cancelling_out_are_not_sent(jog):
+    plugin, send = jog
+    send(z=1)
+    send(z=-1)
+
+    assert not wait_for(lambda: plugin._printer.jogs, timeout=0.3)
+
+
+def test_speed_change_sends_the_pending_move(jog):
+    plugin, send = jog
+    send(x=1)
+    send(x=2, speed=1000)
+
+    assert wait_for(lambda: len(plugin._printer.jogs) == 2)
+    assert plugin._printer.jogs == [({"x": 1.0}, None), ({"x": 2.0}, 1000)]
+
+
+def test_shutdown_drops_the_pending_timers(jog):
+    plugin, send = jog
+    plugin._status_window = plugin._status_max_latency = 30
+    plugin._schedule_printer_status()
+    send(x=1)
+    assert plugin._coalesce_timer is not None and plugin._jog_timer is not None
+
+    plugin.on_shutdown()
+    assert plugin._coalesce_timer is None
+    assert plugin._jog_timer is None
+    assert not wait_for(lambda: plugin._printer.jogs, timeout=0.3)
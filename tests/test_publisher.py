@@ -0,0 +1,200 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+import pytest
+from conftest import wait_for
+
+from octoprint_homeassistant.publisher import (
+    PUBLISH_COMMAND,
+    PUBLISH_DISCOVERY,
+    PUBLISH_STATE,
+    PUBLISH_TELEMETRY,
+    PublishWorker,
+)
+from octoprint_homeassistant.util import TokenBucket
+
+
+class Broker(object):
+    """Records publishes, returns False like the MQTT plugin when disconnected."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connected = True
+        self.published = []
+
+    def publish(self, topic, payload, **kwargs):
+        if not self.connected:
+            return False
+        with self._lock:
+            self.published.append((topic, payload))
+        return True
+
+    def topics(self):
+        with self._lock:
+            return [topic for topic, _ in self.published]
+
+
+@pytest.fixture
+def broker():
+    return Broker()
+
+
+@pytest.fixture
+def make_worker():
+    _workers = []
+
+    def factory(**kwargs):
+        worker = PublishWorker(**kwargs)
+        worker.start()
+        _workers.append(worker)
+        return worker
+
+    yield factory
+    for worker in _workers:
+        worker.stop(timeout=5)
+
+
+def _go_offline(worker, broker, messages):
+    # Publishes one message at a time so each one is rejected by the broker
+    broker.connected = False
+    for topic, payload in messages:
+        worker.submit(PUBLISH_STATE, topic, payload, broker.publish)
+        assert wait_for(lambda: worker.pending() == 0 and topic in worker._offline)
+
+
+def test_publishes_in_class_order(broker):
+    worker = PublishWorker()
+    worker.submit(PUBLISH_TELEMETRY, "telemetry", "1", broker.publish)
+    worker.submit(PUBLISH_STATE, "state", "1", broker.publish)
+    worker.submit(PUBLISH_DISCOVERY, "discovery", "1", broker.publish)
+    worker.submit(PUBLISH_COMMAND, "command", "1", broker.publish)
+    worker.start()
+    try:
+        assert wait_for(lambda: len(broker.published) == 4)
+    finally:
+        worker.stop(timeout=5)
+
+    assert broker.topics() == ["command", "discovery", "state", "telemetry"]
+
+
+def test_state_keeps_last_value_per_topic(broker):
+    worker = PublishWorker()
+    for i in range(5):
+        worker.submit(PUBLISH_STATE, "state", str(i), broker.publish)
+    worker.start()
+    try:
+        assert wait_for(lambda: worker.pending() == 0)
+    finally:
+        worker.stop(timeout=5)
+
+    assert broker.published == [("state", "4")]
+
+
+def test_offline_keeps_last_value_per_topic(make_worker, broker):
+    worker = make_worker()
+    _go_offline(worker, broker, [("a", "1"), ("b", "1"), ("a", "2"), ("a", "3")])
+
+    assert worker.offline() == {"buffered": 2, "bytes": 2, "flushing": 0}
+    assert broker.published == []
+
+
+def test_offline_flushes_after_reconnect(make_worker, broker):
+    worker = make_worker()
+    _go_offline(worker, broker, [("a", "1"), ("b", "1"), ("a", "2")])
+
+    broker.connected = True
+    worker.submit(PUBLISH_STATE, "fresh", "1", broker.publish)
+
+    assert wait_for(lambda: len(broker.published) == 3)
+    # Fresh messages go first, then the buffer, oldest topic first
+    assert broker.published == [("fresh", "1"), ("b", "1"), ("a", "2")]
+    assert worker.offline() == {"buffered": 0, "bytes": 0, "flushing": 0}
+
+
+def test_offline_newer_submit_replaces_buffered(make_worker, broker):
+    worker = make_worker()
+    _go_offline(worker, broker, [("a", "old")])
+
+    broker.connected = True
+    worker.submit(PUBLISH_STATE, "a", "new", broker.publish)
+
+    assert wait_for(lambda: worker.pending() == 0 and broker.published)
+    assert broker.published == [("a", "new")]
+    assert worker.offline()["buffered"] == 0
+
+
+def test_offline_byte_cap_evicts_oldest(make_worker, broker):
+    worker = make_worker(offline_max_bytes=10)
+    _go_offline(worker, broker, [("a", "aaaa"), ("b", "bbbb"), ("c", "cccc")])
+
+    assert list(worker._offline) == ["b", "c"]
+    assert worker.offline()["bytes"] == 8
+    assert worker.dropped[PUBLISH_STATE] == 1
+
+
+def test_offline_drops_oversized_and_raw(make_worker, broker):
+    worker = make_worker(offline_max_bytes=10)
+    broker.connected = False
+    worker.submit(PUBLISH_STATE, "big", "x" * 11, broker.publish)
+    worker.submit(PUBLISH_STATE, "camera", b"jpeg", broker.publish, raw_data=True)
+
+    assert wait_for(lambda: worker.dropped[PUBLISH_STATE] == 2)
+    assert worker.offline()["buffered"] == 0
+
+
+def test_offline_flush_is_rate_limited(make_worker, broker):
+    worker = make_worker(flush_bucket=TokenBucket(0.5, 1))
+    _go_offline(worker, broker, [("a", "1"), ("b", "1"), ("c", "1")])
+
+    broker.connected = True
+    worker.submit(PUBLISH_STATE, "fresh", "1", broker.publish)
+
+    # The burst lets one buffered message through, the next is 2 s away
+    assert wait_for(lambda: len(broker.published) == 2)
+    assert not wait_for(lambda: len(broker.published) > 2, timeout=0.3)
+    assert worker.offline()["flushing"] == 2
+    assert worker.pending() == 2
+
+
+def test_rate_limit_only_throttles_its_class(make_worker, broker):
+    worker = make_worker()
+    worker.set_rate_limit(PUBLISH_DISCOVERY, TokenBucket(0.5, 1))
+    for i in range(3):
+        worker.submit(PUBLISH_DISCOVERY, "discovery/%d" % i, "{}", broker.publish)
+        worker.submit(PUBLISH_STATE, "state/%d" % i, "1", broker.publish)
+
+    assert wait_for(lambda: len(broker.published) == 4)
+    assert not wait_for(lambda: len(broker.published) > 4, timeout=0.3)
+    assert sorted(broker.topics()) == [
+        "discovery/0",
+        "state/0",
+        "state/1",
+        "state/2",
+    ]
+    assert not worker.wait_drained(PUBLISH_DISCOVERY, timeout=0.1)
+
+
+def test_telemetry_drops_oldest_when_full(broker):
+    worker = PublishWorker(max_size=2)
+    for i in range(4):
+        worker.submit(PUBLISH_TELEMETRY, "telemetry", str(i), broker.publish)
+    worker.start()
+    try:
+        assert wait_for(lambda: worker.pending() == 0)
+    finally:
+        worker.stop(timeout=5)
+
+    assert broker.published == [("telemetry", "2"), ("telemetry", "3")]
+    assert worker.dropped[PUBLISH_TELEMETRY] == 2
+
+
+def test_run_pending_without_thread(broker):
+    worker = PublishWorker(flush_bucket=TokenBucket(1, 1))
+    worker.submit(PUBLISH_STATE, "state", "1", broker.publish)
+    worker.submit(PUBLISH_TELEMETRY, "telemetry", "1", broker.publish)
+
+    assert worker.run_pending() == 2
+    assert worker.run_pending() == 0
+    assert broker.topics() == ["state", "telemetry"]
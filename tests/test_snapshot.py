@@ -0,0 +1,108 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from conftest import wait_for
+
+SNAPSHOT = b"\xff\xd8\xff\xe0snapshot\xff\xd9"
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    """Serves a fixed snapshot on /snapshot, slowly on /slow and 404 elsewhere."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith("/slow"):
+            time.sleep(1)
+        if self.path.startswith(("/snapshot", "/slow")):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(SNAPSHOT)))
+            self.end_headers()
+            self.wfile.write(SNAPSHOT)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def streamer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SnapshotHandler)
+    server.daemon_threads = True
+    server.requests = []
+    _thread = threading.Thread(target=server.serve_forever)
+    _thread.daemon = True
+    _thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server, path):
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+
+def test_fetch_snapshot(make_plugin, streamer):
+    plugin, _ = make_plugin(snapshot=_url(streamer, "/snapshot?action=snapshot"))
+
+    assert plugin._fetch_snapshot() == SNAPSHOT
+    assert streamer.requests == ["/snapshot?action=snapshot"]
+
+
+def test_fetch_snapshot_reuses_the_connection(make_plugin, streamer):
+    plugin, _ = make_plugin(snapshot=_url(streamer, "/snapshot"))
+
+    assert plugin._fetch_snapshot() == SNAPSHOT
+    _conn = plugin._snapshot_conn
+    assert plugin._fetch_snapshot() == SNAPSHOT
+    assert plugin._snapshot_conn is _conn
+    assert len(streamer.requests) == 2
+
+
+def test_fetch_snapshot_timeout(make_plugin, streamer):
+    plugin, _ = make_plugin(
+        snapshot=_url(streamer, "/slow"), settings={"snapshot_timeout": 0.2}
+    )
+
+    _start = time.monotonic()
+    with pytest.raises(socket.timeout):
+        plugin._fetch_snapshot()
+    # One retry on a fresh connection, then give up
+    assert time.monotonic() - _start < 1
+    assert plugin._snapshot_conn is None
+
+
+def test_fetch_snapshot_http_error(make_plugin, streamer):
+    plugin, _ = make_plugin(snapshot=_url(streamer, "/missing"))
+
+    with pytest.raises(IOError, match="HTTP status 404"):
+        plugin._fetch_snapshot()
+    assert streamer.requests == ["/missing"]
+
+
+def test_requests_during_a_fetch_keep_the_newest(make_plugin, streamer):
+    plugin, _ = make_plugin(snapshot=_url(streamer, "/slow"))
+    processed = []
+    _publish = plugin._publish_camera_image
+
+    def record(path=None):
+        processed.append(path)
+        _publish(path)
+
+    plugin._publish_camera_image = record
+    plugin._request_snapshot()
+    assert wait_for(lambda: streamer.requests)
+    plugin._request_snapshot("first.jpg")
+    plugin._request_snapshot("second.jpg")
+
+    assert wait_for(lambda: not plugin._snapshot_busy, timeout=5)
+    assert processed == [None, "second.jpg"]
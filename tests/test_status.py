@@ -0,0 +1,134 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+
+import pytest
+from conftest import wait_for
+
+# The fake printer moves the times and file position along with the progress
+THRESHOLDS = {
+    "progress.completion": 1.0,
+    "progress.filepos": 1048576,
+    "progress.printTime": 3600,
+    "progress.printTimeLeft": 3600,
+}
+
+
+@pytest.fixture
+def status(make_plugin):
+    """Returns a plugin whose startup status is out, and the status topic."""
+
+    def factory(**settings):
+        settings.setdefault("discovery_rate", 0)
+        plugin, mqtt = make_plugin(settings=settings)
+        _topic = plugin._generate_topic("hassTopic", "printing", full=True)
+        assert wait_for(
+            lambda: mqtt.messages[_topic] and plugin._publish_worker.pending() == 0
+        )
+        return plugin, mqtt, _topic
+
+    return factory
+
+
+def test_unchanged_status_is_not_published(status):
+    plugin, mqtt, topic = status()
+    mqtt.reset()
+
+    assert not plugin._generate_printer_status()
+    plugin._printer.z = 0.2
+    assert plugin._generate_printer_status()
+    assert not plugin._generate_printer_status()
+
+    assert wait_for(lambda: plugin._publish_worker.pending() == 0)
+    assert mqtt.messages[topic] == 1
+
+
+def test_force_publishes_an_unchanged_status(status):
+    plugin, _, _ = status()
+    assert plugin._generate_printer_status(force=True)
+
+
+def test_thresholds_skip_small_numeric_changes(status):
+    plugin, _, _ = status(status_thresholds=THRESHOLDS)
+    plugin._printer.progress = 10.0
+    assert plugin._generate_printer_status()
+
+    # Compared to the last published value, not the last seen one
+    plugin._printer.progress = 10.5
+    assert not plugin._generate_printer_status()
+    plugin._printer.progress = 10.9
+    assert not plugin._generate_printer_status()
+    plugin._printer.progress = 11.0
+    assert plugin._generate_printer_status()
+
+
+def test_thresholds_only_cover_their_field(status):
+    plugin, _, _ = status(status_thresholds=THRESHOLDS)
+    plugin._printer.progress = 10.0
+    assert plugin._generate_printer_status()
+
+    # The completion is within the threshold, but the state text changed
+    plugin._printer.progress = 10.5
+    plugin._printer.paused = True
+    assert plugin._generate_printer_status()
+
+
+@pytest.fixture
+def flushes(status):
+    """Returns a plugin counting the status publishes of the coalescer."""
+
+    def factory(**settings):
+        plugin, _, _ = status(**settings)
+        _flushes = []
+        plugin._generate_printer_status = lambda: _flushes.append(
+            time.monotonic()
+        )
+        return plugin, _flushes
+
+    return factory
+
+
+def test_bursts_are_coalesced(flushes):
+    plugin, published = flushes(status_coalesce_window=0.1)
+    _merged = plugin._status_merged
+    for _ in range(5):
+        plugin._schedule_printer_status()
+
+    assert wait_for(lambda: published)
+    assert not wait_for(lambda: len(published) > 1, timeout=0.3)
+    assert plugin._status_merged - _merged == 4
+
+
+def test_coalescing_keeps_the_max_latency(flushes):
+    plugin, published = flushes(
+        status_coalesce_window=0.2, status_coalesce_max_latency=0.3
+    )
+    _start = time.monotonic()
+    # Every trigger pushes the publish back, but not past the max latency
+    while time.monotonic() - _start < 0.5:
+        plugin._schedule_printer_status()
+        time.sleep(0.05)
+
+    assert published
+    assert published[0] - _start < 0.45
+
+
+def test_no_window_publishes_right_away(flushes):
+    plugin, published = flushes(status_coalesce_window=0)
+    plugin._schedule_printer_status()
+    assert len(published) == 1
+
+
+def test_split_topics_only_publish_changed_fields(status):
+    plugin, mqtt, topic = status(status_split_topics=True)
+    _split = topic + "/"
+    assert any(t.startswith(_split) for t in mqtt.messages)
+    mqtt.reset()
+
+    plugin._printer.z = 0.4
+    assert plugin._generate_printer_status()
+    assert wait_for(lambda: plugin._publish_worker.pending() == 0)
+
+    assert mqtt.messages[topic] == 1
+    assert [t for t in mqtt.messages if t.startswith(_split)] == [_split + "currentZ"]
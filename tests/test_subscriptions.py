@@ -0,0 +1,48 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from octoprint.events import Events
+from octoprint.settings import settings
+
+BASE_TOPIC = ["plugins", "mqtt", "publish", "baseTopic"]
+MQTT_DEFAULTS = dict(plugins=dict(mqtt=dict(publish=dict(baseTopic="octoPrint/"))))
+
+
+def _topics(mqtt):
+    return sorted(topic for topic, _ in mqtt.subscriptions)
+
+
+def test_subscriptions_are_idempotent(make_plugin):
+    plugin, mqtt = make_plugin()
+    _subscribed = _topics(mqtt)
+    assert len(_subscribed) == len(set(_subscribed))
+
+    plugin._update_subscriptions()
+    plugin._generate_device_controls(subscribe=True)
+    assert _topics(mqtt) == _subscribed
+
+
+def test_discovery_topic_change_moves_the_status_subscription(make_plugin):
+    plugin, mqtt = make_plugin()
+    assert "homeassistant/status" in _topics(mqtt)
+
+    plugin.on_settings_save({"discovery_topic": "ha"})
+    assert "ha/status" in _topics(mqtt)
+    assert "homeassistant/status" not in _topics(mqtt)
+
+
+def test_base_topic_change_resubscribes(make_plugin):
+    plugin, mqtt = make_plugin()
+    _before = _topics(mqtt)
+    assert all(t.startswith("octoPrint/") for t in _before if "status" not in t)
+
+    settings().set(BASE_TOPIC, "printer2/", defaults=MQTT_DEFAULTS)
+    try:
+        plugin.on_event(Events.SETTINGS_UPDATED, {})
+        _after = _topics(mqtt)
+    finally:
+        settings().set(BASE_TOPIC, "octoPrint/", defaults=MQTT_DEFAULTS)
+
+    assert len(_after) == len(_before)
+    assert not any(t.startswith("octoPrint/") for t in _after)
+    assert "printer2/hassControl/+" in _after
@@ -0,0 +1,87 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import time
+
+import pytest
+from conftest import wait_for
+
+import octoprint_homeassistant
+from octoprint.settings import settings
+
+TEMPERATURE_ACTIVE = ["plugins", "mqtt", "publish", "temperatureActive"]
+MQTT_DEFAULTS = dict(plugins=dict(mqtt=dict(publish=dict(temperatureActive=True))))
+
+
+class Clock(object):
+    """Time module whose monotonic clock only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    _clock = Clock()
+    monkeypatch.setattr(octoprint_homeassistant, "time", _clock)
+    return _clock
+
+
+@pytest.fixture
+def heater(make_plugin, clock):
+    plugin, mqtt = make_plugin(settings={"discovery_rate": 0})
+    _topic = plugin._generate_topic("hassTopic", "temperature/tool0", full=True)
+
+    def report(actual, target=200.0, after=0):
+        clock.now += after
+        plugin.on_temperatures_received(None, {"T0": (actual, target)})
+        assert wait_for(lambda: plugin._publish_worker.pending() == 0)
+        return mqtt.messages[_topic]
+
+    return report
+
+
+def test_deadband_skips_small_changes(heater):
+    assert heater(199.0) == 1
+    assert heater(199.4, after=10) == 1
+    assert heater(199.6, after=10) == 2
+
+
+def test_min_interval_holds_large_changes(heater):
+    assert heater(150.0) == 1
+    assert heater(160.0, after=1) == 1
+    assert heater(170.0, after=5) == 2
+
+
+def test_target_change_is_published_right_away(heater):
+    assert heater(25.0, target=0.0) == 1
+    assert heater(25.0, target=200.0) == 2
+
+
+def test_heartbeat(heater):
+    assert heater(200.0) == 1
+    assert heater(200.0, after=59) == 1
+    assert heater(200.0, after=1) == 2
+
+
+def test_warns_while_the_mqtt_temperatures_are_enabled(make_plugin, caplog):
+    with caplog.at_level(logging.WARNING):
+        make_plugin()
+    assert "temperatureActive" in caplog.text
+
+
+def test_no_warning_once_the_mqtt_temperatures_are_disabled(make_plugin, caplog):
+    settings().set(TEMPERATURE_ACTIVE, False, defaults=MQTT_DEFAULTS)
+    try:
+        with caplog.at_level(logging.WARNING):
+            make_plugin()
+    finally:
+        settings().set(TEMPERATURE_ACTIVE, True, defaults=MQTT_DEFAULTS)
+    assert "temperatureActive" not in caplog.text
@@ -0,0 +1,114 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import math
+
+import pytest
+
+from octoprint_homeassistant.util import (
+    RingBuffer,
+    TokenBucket,
+    compile_projection,
+    node_jitter,
+)
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(2, 3)
+    assert [bucket.take() for _ in range(3)] == [0, 0, 0]
+    # Out of tokens, the next one is half a second away at 2 per second
+    assert bucket.take() == pytest.approx(0.5, abs=0.01)
+
+
+def test_token_bucket_without_rate_is_unlimited():
+    bucket = TokenBucket(0, 1)
+    assert all(bucket.take() == 0 for _ in range(100))
+
+
+def test_node_jitter_is_stable_and_spread():
+    _delays = [node_jitter("node%d" % i, 15) for i in range(100)]
+
+    assert _delays == [node_jitter("node%d" % i, 15) for i in range(100)]
+    assert all(0 <= delay < 15 for delay in _delays)
+    assert len(set(_delays)) == 100
+    assert min(_delays) < 3 and max(_delays) > 12
+    assert node_jitter("node0", 0) == 0
+
+
+def test_ring_buffer_summary():
+    buffer = RingBuffer(10)
+    for i, value in enumerate([1.0, 2.0, 3.0, 4.0]):
+        buffer.append(value, now=100.0 + i)
+
+    _summary = buffer.summary(60, now=104.0)
+    assert _summary["count"] == 4
+    assert _summary["min"] == 1.0
+    assert _summary["max"] == 4.0
+    assert _summary["mean"] == pytest.approx(2.5)
+    assert _summary["stddev"] == pytest.approx(math.sqrt(1.25))
+
+
+def test_ring_buffer_summary_only_covers_the_window():
+    buffer = RingBuffer(10)
+    for i in range(10):
+        buffer.append(float(i), now=float(i))
+
+    _summary = buffer.summary(2.5, now=9.0)
+    assert _summary["count"] == 3
+    assert (_summary["min"], _summary["max"]) == (7.0, 9.0)
+
+
+def test_ring_buffer_summary_empty():
+    buffer = RingBuffer(10)
+    assert buffer.summary(60) is None
+
+    buffer.append(1.0, now=0.0)
+    assert buffer.summary(60, now=100.0) is None
+
+
+def test_ring_buffer_overwrites_oldest():
+    buffer = RingBuffer(3)
+    for i in range(7):
+        buffer.append(float(i), now=float(i))
+
+    _summary = buffer.summary(100, now=7.0)
+    assert buffer.count == 3
+    assert _summary["count"] == 3
+    assert (_summary["min"], _summary["max"]) == (4.0, 6.0)
+    assert _summary["mean"] == pytest.approx(5.0)
+
+
+def test_ring_buffer_constant_values_have_no_stddev():
+    buffer = RingBuffer(100)
+    for i in range(100):
+        buffer.append(215.3, now=float(i))
+
+    assert buffer.summary(1000, now=100.0)["stddev"] == pytest.approx(0.0)
+
+
+def test_compile_projection():
+    project = compile_projection(["state.text", "progress", "job.file.name", "missing.field"])
+    data = {
+        "state": {"text": "Printing", "flags": {"printing": True}},
+        "progress": {"completion": 50.0, "printTime": 10},
+        "job": {"file": {"name": "benchy.gcode", "size": 1}, "user": "octoprint"},
+        "offsets": {},
+    }
+
+    assert project(data) == {
+        "state": {"text": "Printing"},
+        "progress": {"completion": 50.0, "printTime": 10},
+        "job": {"file": {"name": "benchy.gcode"}},
+    }
+
+
+def test_compile_projection_parent_selects_whole_value():
+    project = compile_projection(["progress", "progress.completion"])
+    assert project({"progress": {"completion": 1, "printTime": 2}}) == {
+        "progress": {"completion": 1, "printTime": 2}
+    }
+
+
+def test_compile_projection_keeps_non_dict_values():
+    project = compile_projection(["job.file.name"])
+    assert project({"job": None}) == {"job": None}